@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""Run es-backup.py subcommands against the fake elasticsearch of fake_es.py
+and report the requests sent, wall time and peak memory of each.
+
+The startup time of each command is measured as the wall time of
+`<command> --help`, which imports and parses everything a command needs
+before its first request. Commands starting slower than the startup budget
+are reported and make the benchmark exit with status 1."""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+from fake_es import EPOCH, FakeCluster, FakeServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+SCRIPT = os.path.join(ROOT, 'es-backup.py')
+REPO = 'backup_20200106'
+
+# repo-usage, repo-verify, repo-clone, archive and unarchive read the files
+# of a repository, which the fake cluster does not have, and daemon runs
+# until stopped, so they are left out.
+COMMANDS = [
+    ('repo-list', ['repo-list']),
+    ('repo-details', ['repo-details', REPO]),
+    ('repo-create', ['repo-create', 'fs', 'bench_repo', '-l', '{tmp}/repo']),
+    ('repo-delete', ['repo-delete', REPO]),
+    ('snapshot-list', ['snapshot-list', REPO]),
+    ('snapshot-details', ['snapshot-details', REPO, 'snap_000000']),
+    ('snapshot-create', ['snapshot-create', REPO, 'bench_snap', '--wait']),
+    ('snapshot-delete', ['snapshot-delete', REPO, 'snap_000000']),
+    ('snapshot-restore', ['snapshot-restore', REPO, 'snap_000000',
+                          '-i', 'index-000,index-001',
+                          '--rename-pattern', '(.+)',
+                          '--rename-replacement', 'restored_$1']),
+    ('snapshot-prune', ['snapshot-prune', REPO, '--keep-last', '10',
+                        '--dry-run']),
+    ('scheduled-backup', ['scheduled-backup', '--wait']),
+    ('age-out', ['age-out', '--count', '2', '--dry-run']),
+    ('batch', ['batch', '-f', '{tmp}/batch.ndjson']),
+    ('cache-clear', ['cache-clear']),
+]
+
+# Commands filling the metadata cache before each measured run with --cache
+WARM_UP = [
+    ['repo-list'],
+    ['snapshot-list', REPO],
+    ['snapshot-prune', REPO, '--keep-last', '10', '--dry-run'],
+    ['snapshot-details', REPO, 'snap_000000'],
+]
+
+
+def write_batch(path, repos, snapshots, count=200):
+    """Write count batch requests showing and creating snapshots spread
+    over the repositories."""
+    with open(path, 'w') as batch:
+        for i in range(count):
+            repo = 'backup_%s' % (EPOCH + timedelta(days=7 * (i % repos))
+                                  ).strftime('%Y%m%d')
+            if i % 4:
+                request = {'command': 'snapshot-details',
+                           'args': [repo, 'snap_%06d' % (i % snapshots)]}
+            else:
+                request = {'command': 'snapshot-create',
+                           'args': [repo, 'batch_%s' % i],
+                           'options': {'wait': True}}
+            batch.write(json.dumps(request) + '\n')
+
+
+def write_config(path, tmp, url, cache):
+    parser = configparser.RawConfigParser()
+    parser.read(os.path.join(ROOT, 'etc', 'es_backup.conf'))
+    overrides = {
+        'default': {'base_url': url, 'retries': '0'},
+        'cache': {'enabled': str(cache).lower(),
+                  'path': os.path.join(tmp, 'cache')},
+        'backup': {'full_backup_count': '100000', 'wait': 'true'},
+        'fs': {'backup_base_path': os.path.join(tmp, 'backups')},
+        'throttle': {'enabled': 'false'},
+        'metrics': {'format': 'none'},
+        'daemon': {'lock_path': os.path.join(tmp, 'locks')},
+    }
+    for section, options in overrides.items():
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for option, value in options.items():
+            parser.set(section, option, value)
+    with open(path, 'w') as config_file:
+        parser.write(config_file)
+
+
+def run_command(python, argv, env, output):
+    """Run one command and return its exit status, wall time in seconds and
+    peak resident memory in kilobytes."""
+    started = time.time()
+    process = subprocess.Popen([python, SCRIPT] + argv, env=env,
+                               stdout=output, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    wall = time.time() - started
+    peak = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return os.WEXITSTATUS(status), wall, peak
+
+
+def startup_time(python, command, env, runs):
+    """Return the fastest of runs startups of command in seconds."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for run in range(runs):
+            times.append(run_command(python, [command, '--help'], env,
+                                     devnull)[1])
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark es-backup.py '
+                                     'against a fake elasticsearch')
+    parser.add_argument('-r', '--repos', type=int, default=10,
+                        help='Number of repositories (Default: 10)')
+    parser.add_argument('-s', '--snapshots', type=int, default=1000,
+                        help='Snapshots per repository (Default: 1000)')
+    parser.add_argument('-i', '--indices', type=int, default=20,
+                        help='Indices per snapshot (Default: 20)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Added latency per request in milliseconds')
+    parser.add_argument('-t', '--snapshot-time', type=float, default=0.0,
+                        help='Seconds a created snapshot stays in progress')
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='Runs of each command, the fastest is reported '
+                        '(Default: 3)')
+    parser.add_argument('-c', '--commands', help='Comma separated list of '
+                        'commands to run (Default: all)')
+    parser.add_argument('--cache', action='store_true', help='Enable the '
+                        'metadata cache, filled by untimed read-only '
+                        'commands before each run')
+    parser.add_argument('-b', '--startup-budget', type=float, default=150.0,
+                        help='Startup time allowed per command in '
+                        'milliseconds (Default: 150)')
+    parser.add_argument('--python', default=sys.executable, help='Python '
+                        'interpreter running es-backup.py')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the output of each command')
+    args = parser.parse_args()
+
+    commands = COMMANDS
+    if args.commands:
+        selected = args.commands.split(',')
+        commands = [command for command in COMMANDS
+                    if command[0] in selected]
+
+    cluster = FakeCluster(repos=args.repos, snapshots=args.snapshots,
+                          indices=args.indices,
+                          snapshot_time=args.snapshot_time)
+    server = FakeServer(cluster, latency=args.latency / 1000.0).start()
+    tmp = tempfile.mkdtemp(prefix='es-backup-bench-')
+    config_path = os.path.join(tmp, 'es_backup.conf')
+    write_config(config_path, tmp, server.url, args.cache)
+    write_batch(os.path.join(tmp, 'batch.ndjson'), args.repos,
+                args.snapshots)
+    env = dict(os.environ, CONFIG=config_path)
+
+    started = time.time()
+    subprocess.call([args.python, '-c', 'pass'])
+    print('%s repos, %s snapshots each, %s ms latency, interpreter starts '
+          'in %.0f ms' % (args.repos, args.snapshots, args.latency,
+                          (time.time() - started) * 1000))
+    print('%-18s %6s %9s %9s %10s %12s %s' % (
+          'command', 'status', 'requests', 'wall (s)', 'peak (MB)',
+          'startup (ms)', 'output'))
+    over_budget = []
+    try:
+        for label, argv in commands:
+            argv = [arg.format(tmp=tmp) for arg in argv]
+            results = []
+            for run in range(args.runs):
+                # The cache has to describe the cluster as reset, so both
+                # start over and the cache is filled without changing it.
+                cluster.reset()
+                shutil.rmtree(os.path.join(tmp, 'cache'), ignore_errors=True)
+                if args.cache:
+                    with open(os.devnull, 'w') as devnull:
+                        for warm_up in WARM_UP:
+                            run_command(args.python, warm_up, env, devnull)
+                    cluster.clear_requests()
+                with tempfile.TemporaryFile() as output:
+                    status, wall, peak = run_command(args.python, argv, env,
+                                                     output)
+                    size = output.tell()
+                    output.seek(0)
+                    text = output.read().decode('utf-8', 'replace')
+                results.append((wall, status, cluster.total_requests, peak,
+                                size))
+            wall, status, requests, peak, size = min(results)
+            startup = startup_time(args.python, argv[0], env,
+                                   args.runs) * 1000
+            if startup > args.startup_budget:
+                over_budget.append(label)
+            print('%-18s %6s %9s %9.3f %10.1f %11.0f%s %s' % (
+                  label, status, requests, wall, peak / 1024.0, startup,
+                  '!' if startup > args.startup_budget else ' ',
+                  '%s bytes' % size))
+            if args.verbose or status:
+                sys.stdout.write(text)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+    if over_budget:
+        print('Startup budget of %.0f ms exceeded by %s' % (
+              args.startup_budget, ', '.join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""In-process stand-in for the elasticsearch endpoints used by es-backup.
+
+Repositories and snapshots are synthesized from their position on request,
+so clusters with 100k snapshots cost no memory until they are listed.
+Changes made through the API are kept as overlays on top of the synthetic
+data and dropped by reset().
+"""
+
+import argparse
+import fnmatch
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+EPOCH = datetime(2020, 1, 6)
+VERSION = '7.10.2'
+
+
+def _millis(when):
+    return int((when - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _iso(when):
+    return when.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class FakeCluster(object):
+    def __init__(self, repos=10, snapshots=100, indices=20, shards=5,
+                 snapshot_time=0.0, base_path='/tmp/es-backup-fake'):
+        self.repo_count = repos
+        self.snapshot_count = snapshots
+        self.index_count = indices
+        self.shards = shards
+        self.snapshot_time = snapshot_time
+        self.base_path = base_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.created_repos = {}
+            self.deleted_repos = set()
+            self.created_snapshots = {}
+            self.deleted_snapshots = set()
+            self.restores = set()
+
+    def clear_requests(self):
+        with self.lock:
+            self.requests = {}
+
+    def count(self, method, path):
+        with self.lock:
+            key = '%s %s' % (method, path)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    @property
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def indices(self):
+        return ['index-%03d' % i for i in range(self.index_count)]
+
+    def repo_names(self):
+        names = []
+        for i in range(self.repo_count):
+            date = EPOCH + timedelta(days=7 * i)
+            names.append('backup_%s' % date.strftime('%Y%m%d'))
+        names = [name for name in names if name not in self.deleted_repos]
+        return names + sorted(self.created_repos)
+
+    def repo(self, name):
+        if name in self.deleted_repos:
+            return None
+        if name in self.created_repos:
+            return self.created_repos[name]
+        if name not in self.repo_names():
+            return None
+        return {'type': 'fs', 'uuid': 'uuid-%s' % name,
+                'settings': {'location': '%s/%s' % (self.base_path,
+                                                    name.split('_')[-1]),
+                             'compress': 'true',
+                             'max_restore_bytes_per_sec': '20mb',
+                             'max_snapshot_bytes_per_sec': '20mb'}}
+
+    def __synthetic(self, repo, i, verbose=True):
+        start = EPOCH + timedelta(hours=i)
+        name = 'snap_%06d' % i
+        snapshot = {'snapshot': name, 'uuid': '%s-%06d' % (repo, i),
+                    'indices': self.indices(), 'state': 'SUCCESS'}
+        if verbose:
+            end = start + timedelta(seconds=90)
+            snapshot.update({
+                'version_id': 7100299, 'version': VERSION,
+                'data_streams': [], 'include_global_state': True,
+                'start_time': _iso(start),
+                'start_time_in_millis': _millis(start),
+                'end_time': _iso(end), 'end_time_in_millis': _millis(end),
+                'duration_in_millis': 90000, 'failures': [],
+                'shards': {'total': self.index_count * self.shards,
+                           'failed': 0,
+                           'successful': self.index_count * self.shards}})
+        return snapshot
+
+    def __created(self, repo, name):
+        snapshot = dict(self.created_snapshots[(repo, name)])
+        elapsed = time.time() - snapshot.pop('created')
+        if elapsed < self.snapshot_time:
+            snapshot['state'] = 'IN_PROGRESS'
+            snapshot.pop('end_time', None)
+            snapshot.pop('end_time_in_millis', None)
+            snapshot.pop('duration_in_millis', None)
+        return snapshot
+
+    def snapshots(self, repo, verbose=True):
+        for i in range(self.snapshot_count):
+            name = 'snap_%06d' % i
+            if (repo, name) not in self.deleted_snapshots:
+                yield self.__synthetic(repo, i, verbose)
+        for (created_repo, name) in sorted(self.created_snapshots):
+            if created_repo == repo and \
+                    (repo, name) not in self.deleted_snapshots:
+                yield self.__created(repo, name)
+
+    def snapshot(self, repo, name):
+        if (repo, name) in self.deleted_snapshots:
+            return None
+        if (repo, name) in self.created_snapshots:
+            return self.__created(repo, name)
+        match = re.match(r'^snap_(\d+)$', name)
+        if match and int(match.group(1)) < self.snapshot_count:
+            return self.__synthetic(repo, int(match.group(1)))
+        return None
+
+    def create_snapshot(self, repo, name, body):
+        now = datetime.utcnow()
+        indices = body.get('indices', '_all')
+        if indices in ('_all', '*'):
+            indices = self.indices()
+        else:
+            indices = [index for index in self.indices()
+                       if any(fnmatch.fnmatch(index, pattern)
+                              for pattern in indices.split(','))]
+        end = now + timedelta(seconds=self.snapshot_time)
+        shards = len(indices) * self.shards
+        self.created_snapshots[(repo, name)] = {
+            'snapshot': name, 'uuid': '%s-%s' % (repo, name),
+            'indices': indices, 'state': 'SUCCESS', 'created': time.time(),
+            'version_id': 7100299, 'version': VERSION,
+            'include_global_state': body.get('include_global_state', True),
+            'start_time': _iso(now), 'start_time_in_millis': _millis(now),
+            'end_time': _iso(end), 'end_time_in_millis': _millis(end),
+            'duration_in_millis': int(self.snapshot_time * 1000),
+            'failures': [],
+            'shards': {'total': shards, 'failed': 0, 'successful': shards}}
+        self.deleted_snapshots.discard((repo, name))
+
+    def status(self, repo, name):
+        snapshot = self.snapshot(repo, name)
+        size = 1024 * 1024 * len(snapshot['indices'])
+        fraction = 1.0
+        if snapshot['state'] == 'IN_PROGRESS' and self.snapshot_time:
+            created = self.created_snapshots[(repo, name)]['created']
+            fraction = min(1.0, (time.time() - created) / self.snapshot_time)
+        state = 'STARTED' if snapshot['state'] == 'IN_PROGRESS' else \
+            'SUCCESS'
+
+        def stats(total):
+            return {'incremental': {'file_count': 10,
+                                    'size_in_bytes': total},
+                    'processed': {'file_count': int(10 * fraction),
+                                  'size_in_bytes': int(total * fraction)},
+                    'total': {'file_count': 10, 'size_in_bytes': total},
+                    'start_time_in_millis': snapshot['start_time_in_millis'],
+                    'time_in_millis': 1000}
+
+        indices = {}
+        for index in snapshot['indices']:
+            shards = {}
+            for shard in range(self.shards):
+                shards[str(shard)] = {
+                    'stage': 'DONE' if fraction >= 1 else 'STARTED',
+                    'node': 'node-%d' % (shard % 3),
+                    'stats': stats(size // len(snapshot['indices']) //
+                                   self.shards)}
+            indices[index] = {'shards': shards,
+                              'stats': stats(size // len(snapshot['indices']))}
+        total = len(snapshot['indices']) * self.shards
+        done = total if fraction >= 1 else 0
+        return {'snapshot': name, 'repository': repo, 'state': state,
+                'shards_stats': {'initializing': 0, 'started': total - done,
+                                 'finalizing': 0, 'done': done, 'failed': 0,
+                                 'total': total},
+                'stats': stats(size), 'indices': indices}
+
+
+def filter_paths(body, paths):
+    """Apply an elasticsearch filter_path of dotted field names to body."""
+    if not isinstance(body, dict):
+        if isinstance(body, list):
+            return [filter_paths(item, paths) for item in body]
+        return body
+    filtered = {}
+    for field, value in body.items():
+        nested = [path[len(field) + 1:] for path in paths
+                  if path.startswith(field + '.')]
+        if field in paths:
+            filtered[field] = value
+        elif nested:
+            filtered[field] = filter_paths(value, nested)
+    return filtered
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def __reply(self, status, body):
+        if status < 300 and self.filter_path:
+            body = filter_paths(body, self.filter_path.split(','))
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def __missing(self, kind, name):
+        self.__reply(404, {'error': {'type': '%s_missing_exception' % kind,
+                                     'reason': '[%s] missing' % name},
+                           'status': 404})
+
+    def __handle(self, method):
+        cluster = self.server.cluster
+        # base_url ends in a slash, so paths may start with //
+        url = urlparse(re.sub(r'^/+', '/', self.path))
+        query = dict((key, values[-1])
+                     for key, values in parse_qs(url.query).items())
+        self.filter_path = query.get('filter_path')
+        parts = [part for part in url.path.split('/') if part]
+        body = self.__body() if method in ('PUT', 'POST') else {}
+        cluster.count(method, '/' + '/'.join(
+            part if part.startswith('_') else '*' for part in parts))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if not parts:
+            return self.__reply(200, {'name': 'fake',
+                                      'version': {'number': VERSION}})
+        if parts[0] == '_snapshot':
+            return self.__snapshot_api(method, parts[1:], query, body)
+        if parts[0] == '_cat' and parts[1:2] == ['indices']:
+            patterns = parts[2].split(',') if len(parts) > 2 else ['*']
+            rows = [{'index': index, 'store.size': str(1024 ** 3 * (i + 1))}
+                    for i, index in enumerate(cluster.indices())
+                    if any(fnmatch.fnmatch(index, pattern) or
+                           pattern == '_all' for pattern in patterns)]
+            return self.__reply(200, rows)
+        if parts[0] == '_nodes':
+            nodes = {}
+            for i in range(3):
+                nodes['node-%d' % i] = {
+                    'name': 'node-%d' % i,
+                    'indices': {'search': {'query_total': 0,
+                                           'query_time_in_millis': 0}},
+                    'thread_pool': {'search': {'queue': 0},
+                                    'write': {'queue': 0}},
+                    'fs': {'io_stats': {'total': {'io_time_in_millis': 0}}}}
+            return self.__reply(200, {'nodes': nodes})
+        if len(parts) == 2 and parts[1] == '_recovery':
+            recovery = {}
+            for index in parts[0].split(','):
+                if index in cluster.restores:
+                    size = {'total_in_bytes': 1024, 'recovered_in_bytes': 1024}
+                    recovery[index] = {'shards': [
+                        {'id': shard, 'primary': True, 'stage': 'DONE',
+                         'type': 'SNAPSHOT', 'index': {'size': size}}
+                        for shard in range(cluster.shards)]}
+            return self.__reply(200, recovery)
+        return self.__reply(400, {'error': 'unsupported %s %s' %
+                                  (method, url.path)})
+
+    def __snapshot_api(self, method, parts, query, body):
+        cluster = self.server.cluster
+        if not parts or parts == ['_all']:
+            return self.__reply(200, dict((name, cluster.repo(name))
+                                          for name in cluster.repo_names()))
+        repo_name = parts[0]
+        repo = cluster.repo(repo_name)
+        if len(parts) == 1:
+            if method == 'PUT':
+                with cluster.lock:
+                    cluster.created_repos[repo_name] = body
+                    cluster.deleted_repos.discard(repo_name)
+                return self.__reply(200, {'acknowledged': True})
+            if repo is None:
+                return self.__missing('repository', repo_name)
+            if method == 'DELETE':
+                with cluster.lock:
+                    cluster.created_repos.pop(repo_name, None)
+                    cluster.deleted_repos.add(repo_name)
+                return self.__reply(200, {'acknowledged': True})
+            return self.__reply(200, {repo_name: repo})
+        if repo is None:
+            return self.__missing('repository', repo_name)
+
+        names = parts[1]
+        if names in ('_all', '*'):
+            verbose = query.get('verbose', 'true') != 'false'
+            return self.__reply(200, {'snapshots': list(
+                cluster.snapshots(repo_name, verbose))})
+        if len(parts) == 3 and parts[2] == '_status':
+            if cluster.snapshot(repo_name, names) is None:
+                return self.__missing('snapshot', names)
+            return self.__reply(200, {'snapshots': [
+                cluster.status(repo_name, names)]})
+        if len(parts) == 3 and parts[2] == '_restore':
+            snapshot = cluster.snapshot(repo_name, names)
+            if snapshot is None:
+                return self.__missing('snapshot', names)
+            indices = body.get('indices') or ','.join(snapshot['indices'])
+            with cluster.lock:
+                for index in indices.split(','):
+                    if body.get('rename_pattern'):
+                        index = re.sub(body['rename_pattern'],
+                                       re.sub(r'\$(\d+)', r'\\\1',
+                                              body['rename_replacement']),
+                                       index)
+                    cluster.restores.add(index)
+            return self.__reply(200, {'accepted': True})
+        if method == 'PUT':
+            if cluster.snapshot(repo_name, names) is not None:
+                return self.__reply(400, {'error': 'snapshot exists'})
+            with cluster.lock:
+                cluster.create_snapshot(repo_name, names, body)
+            return self.__reply(200, {'accepted': True})
+        found = []
+        for name in names.split(','):
+            snapshot = cluster.snapshot(repo_name, name)
+            if snapshot is None:
+                return self.__missing('snapshot', name)
+            found.append(snapshot)
+        if method == 'DELETE':
+            with cluster.lock:
+                for name in names.split(','):
+                    cluster.deleted_snapshots.add((repo_name, name))
+            return self.__reply(200, {'acknowledged': True})
+        return self.__reply(200, {'snapshots': found})
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cluster, port=0, latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.cluster = cluster
+        self.latency = latency
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake '
+                                     'elasticsearch snapshot API')
+    parser.add_argument('-p', '--port', type=int, default=9200)
+    parser.add_argument('-r', '--repos', type=int, default=10,
+                        help='Number of repositories (Default: 10)')
+    parser.add_argument('-s', '--snapshots', type=int, default=100,
+                        help='Snapshots per repository (Default: 100)')
+    parser.add_argument('-i', '--indices', type=int, default=20,
+                        help='Indices per snapshot (Default: 20)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Added latency per request in milliseconds')
+    parser.add_argument('-t', '--snapshot-time', type=float, default=0.0,
+                        help='Seconds a created snapshot stays in progress')
+    args = parser.parse_args()
+    cluster = FakeCluster(repos=args.repos, snapshots=args.snapshots,
+                          indices=args.indices,
+                          snapshot_time=args.snapshot_time)
+    server = FakeServer(cluster, port=args.port,
+                        latency=args.latency / 1000.0)
+    print('Serving fake elasticsearch at %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,33 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import sys
-from es_backup.repository import *
-from es_backup.snapshot import *
-from es_backup.backup import *
-from jinja2 import Environment, PackageLoader
+import es_backup
+from es_backup.config import config, option
+from es_backup.metrics import metrics
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(es_backup.__file__), 'templates')
+
+_environment = None
 
 
 def render_template(template, **variables):
-    env = Environment(loader=PackageLoader('es_backup', 'templates'))
-    template = env.get_template(template)
-    print(template.render(**variables))
+    global _environment
+    if _environment is None:
+        from jinja2 import Environment, FileSystemLoader
+        _environment = Environment(loader=FileSystemLoader(TEMPLATE_PATH),
+                                   auto_reload=False)
+    template = _environment.get_template(template)
+    for chunk in template.generate(**variables):
+        sys.stdout.write(chunk)
+    sys.stdout.write('\n')
 
 
 class Commands(object):
-    def __init__(self):
+    def __init__(self, argv=None, export=True):
+        if argv is None:
+            argv = sys.argv[1:]
         parser = argparse.ArgumentParser(description='Elasticsearch backup '
                                          'management utility',
                                          usage=('''es-backup.py <command> [<args>]
@@ -25,40 +37,117 @@ Commands
     repo-details
     repo-create
     repo-delete
+    repo-usage
+    repo-clone
+    repo-verify
     snapshot-list
     snapshot-details
     snapshot-create
     snapshot-delete
+    snapshot-restore
+    snapshot-prune
     scheduled-backup
+    age-out
+    archive
+    unarchive
+    cache-clear
+    daemon
+    batch
 '''))
         parser.add_argument('command', help='Subcommand to run')
-        args = parser.parse_args(sys.argv[1:2])
+        args = parser.parse_args(argv[:1])
+        self.argv = argv[1:]
         command = args.command.replace('-', '_')
         if not hasattr(self, command):
             print('Unrecognized command')
             parser.print_help()
             sys.exit(1)
         func = getattr(self, command)
-        func()
+        try:
+            func()
+        finally:
+            if export:
+                metrics.export()
 
     def __arg_conf(self, argv=None, config=None):
         if argv is None:
             return config
         return argv
 
-    def repo_list(self):
+    def __offline_args(self, parser):
+        parser.add_argument('--offline', action='store_true', help='Read an '
+                            'fs repository from disk instead of through '
+                            'elasticsearch')
+        parser.add_argument('-l', '--location', help='Path of the repository '
+                            '(required with --offline)')
+
+    def __offline_repo(self, parser, args, name):
+        from es_backup.catalog import OfflineRepository
+        if not args.location:
+            parser.error('--location is required with --offline')
+        return OfflineRepository(name, args.location)
+
+    def __cluster_args(self, parser):
+        parser.add_argument('-C', '--cluster', action='append', help='Run '
+                            'against a [cluster:<name>] section of the '
+                            'config; repeat for several clusters or use '
+                            '"all"')
+
+    def __clusters(self, parser, args):
+        from es_backup.clusters import cluster_names
+        if not args.cluster:
+            return None
+        configured = cluster_names()
+        if 'all' in args.cluster:
+            return configured
+        for cluster in args.cluster:
+            if cluster not in configured:
+                parser.error('Cluster %s is not configured' % cluster)
+        return args.cluster
+
+    def __fan_out(self, clusters, func, *args):
+        from es_backup.clusters import fan_out, print_report
+        timeout = option('default', 'cluster_timeout', 0,
+                         'getfloat') or None
+        results = fan_out([(cluster, None, func, args)
+                           for cluster in clusters],
+                          workers=option('default', 'fan_out_workers', 8,
+                                         'getint'),
+                          per_cluster=option('default', 'cluster_concurrency',
+                                             1, 'getint'),
+                          timeout=timeout)
+        print_report(results)
+        return results
+
+    def __repo_list(self):
+        from es_backup.repository import list_repos
         repos = list_repos()
         render_template('repo_list', repos=repos)
 
+    def repo_list(self):
+        parser = argparse.ArgumentParser(description='List repositories')
+        self.__cluster_args(parser)
+        args = parser.parse_args(self.argv)
+        clusters = self.__clusters(parser, args)
+        if clusters is None:
+            self.__repo_list()
+        else:
+            self.__fan_out(clusters, self.__repo_list)
+
     def repo_details(self):
+        from es_backup.repository import (Azure_Repository, FileRepository,
+                                          HDFS_Repository, S3_Repository)
         parser = argparse.ArgumentParser(description='Show repository details')
         parser.add_argument('name', help='Name of repository')
         parser.add_argument('-t', '--type', default='fs', choices=['fs', 's3',
                             'azure', 'hdfs'], help='Repository type (fs, s3, '
                             'azure, hdfs)')
-        args = parser.parse_args(sys.argv[2:])
+        self.__offline_args(parser)
+        args = parser.parse_args(self.argv)
         name = args.name
-        if args.type == 'fs':
+        if args.offline:
+            repo = self.__offline_repo(parser, args, name)
+        elif args.type == 'fs':
             repo = FileRepository(name)
         if args.type == 's3':
             repo = S3_Repository(name)
@@ -69,6 +158,7 @@ Commands
         render_template('repo_details', repo=repo)
 
     def __fs_repo_create(self, args):
+        from es_backup.repository import FileRepository
         compress = self.__arg_conf(args.compress,
                                    config.get('fs', 'compress'))
         chunk_size = self.__arg_conf(args.chunk_size,
@@ -160,37 +250,202 @@ Commands
         parser_hdfs.add_argument('name', help='Name of repository')
         parser_hdfs.set_defaults(func=self.__hdfs_repo_create)
 
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
         args.func(args)
 
     def repo_delete(self):
+        from es_backup.repository import Repository
         parser = argparse.ArgumentParser(description='Delete a repository')
         parser.add_argument('name', help='Name of repository')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
         repo = Repository(args.name)
         repo.delete()
         print('Repository %s deleted' % repo.name)
 
+    def repo_clone(self):
+        from es_backup.clone import CloneError, clone_repo
+        from es_backup.progress import format_bytes
+        from es_backup.repository import Repository
+        parser = argparse.ArgumentParser(description='Copy the files of an fs '
+                                         'repository to another location, '
+                                         'hardlinking or skipping blobs '
+                                         'where possible, and register the '
+                                         'copy')
+        parser.add_argument('name', help='Name of repository')
+        parser.add_argument('clone', help='Name of the cloned repository')
+        parser.add_argument('-l', '--location', required=True, help='Path '
+                            'of the cloned repository')
+        parser.add_argument('-w', '--workers', type=int, help='Number of '
+                            'files transferred at once (Default: 8)')
+        parser.add_argument('--writable', action='store_true', help='Register '
+                            'the clone as a writable repository (Default: '
+                            'readonly)')
+        parser.add_argument('--delete', action='store_true', help='Remove '
+                            'files of an earlier clone that the repository '
+                            'no longer has. The location must be empty or '
+                            'hold a repository')
+        parser.add_argument('--no-register', action='store_true',
+                            help='Only copy the files, for a location this '
+                            'cluster can not reach')
+        args = parser.parse_args(self.argv)
+        registration = Repository(args.name).get_settings()
+        if registration.get('type') != 'fs':
+            print('Repository %s is not an fs repository' % args.name)
+            sys.exit(1)
+        workers = self.__arg_conf(args.workers,
+                                  option('fs', 'clone_workers', 8, 'getint'))
+        try:
+            report = clone_repo(registration['settings']['location'],
+                                args.location, workers=workers,
+                                delete=args.delete)
+        except CloneError as error:
+            print('Can not clone %s: %s' % (args.name, error))
+            sys.exit(1)
+        print('Cloned %s to %s at generation %s: %s linked, %s copied (%s), '
+              '%s unchanged, %s deleted' % (
+                  args.name, args.location, report['generation'],
+                  report['linked'], report['copied'],
+                  format_bytes(report['bytes']), report['skipped'],
+                  report['deleted']))
+        if not args.no_register:
+            registration['settings']['location'] = args.location
+            registration['settings']['readonly'] = not args.writable
+            Repository(args.clone).register(registration)
+            print('Repository %s registered at %s' % (args.clone,
+                                                      args.location))
+
+    def repo_usage(self):
+        from es_backup.progress import format_bytes
+        from es_backup.repository import FileRepository
+        from es_backup.usage import repo_usage
+        parser = argparse.ArgumentParser(description='Show unique and shared '
+                                         'bytes of each snapshot in an fs '
+                                         'repository')
+        parser.add_argument('name', help='Name of repository')
+        parser.add_argument('-l', '--location', help='Path of the repository '
+                            '(Default: looked up through elasticsearch)')
+        parser.add_argument('-d', '--delete', help='Comma separated list of '
+                            'snapshots to report reclaimable space for')
+        parser.add_argument('-w', '--workers', type=int, help='Number of '
+                            'processes scanning the repository (Default: 4)')
+        args = parser.parse_args(self.argv)
+        location = args.location or FileRepository(args.name).location
+        workers = self.__arg_conf(args.workers,
+                                  option('fs', 'scan_workers', 4, 'getint'))
+        delete = args.delete.split(',') if args.delete else None
+        usage = repo_usage(location, workers=workers, delete=delete)
+        render_template('repo_usage', usage=usage, format_bytes=format_bytes)
+
+    def repo_verify(self):
+        from es_backup.progress import format_bytes
+        from es_backup.repository import FileRepository
+        from es_backup.verify import state_path, verify_repo
+        parser = argparse.ArgumentParser(description='Check the blobs of an '
+                                         'fs repository for existence, size '
+                                         'and checksum')
+        parser.add_argument('name', help='Name of repository')
+        parser.add_argument('-l', '--location', help='Path of the repository '
+                            '(Default: looked up through elasticsearch)')
+        parser.add_argument('-w', '--workers', type=int, help='Number of '
+                            'processes hashing blobs (Default: 4)')
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            help='Only hash blobs changed since they were '
+                            'last verified')
+        parser.add_argument('--state-file', help='File recording verified '
+                            'blobs for --incremental (Default: in the cache '
+                            'directory)')
+        args = parser.parse_args(self.argv)
+        location = args.location or FileRepository(args.name).location
+        workers = self.__arg_conf(args.workers,
+                                  option('fs', 'verify_workers', 4, 'getint'))
+        state_file = None
+        if args.incremental:
+            state_file = args.state_file or state_path(
+                option('cache', 'path', '~/.cache/es-backup'),
+                os.path.abspath(location))
+        report = verify_repo(location, workers=workers,
+                             state_file=state_file)
+        render_template('repo_verify', report=report,
+                        format_bytes=format_bytes)
+        if report['broken']:
+            sys.exit(1)
+
     def snapshot_list(self):
+        from es_backup.repository import Repository
         parser = argparse.ArgumentParser(description='List snapshots in a '
                                          'repository')
         parser.add_argument('repo', help='Name of repository')
-        args = parser.parse_args(sys.argv[2:])
-        repo = Repository(args.repo)
-        snapshots = repo.list_snapshots()
+        self.__offline_args(parser)
+        self.__cluster_args(parser)
+        args = parser.parse_args(self.argv)
+        clusters = self.__clusters(parser, args)
+        if args.offline:
+            repo = self.__offline_repo(parser, args, args.repo)
+        elif clusters is not None:
+            self.__fan_out(clusters, self.__snapshot_list, args.repo)
+            return
+        else:
+            repo = Repository(args.repo)
+        self.__snapshot_list(args.repo, repo)
+
+    def __snapshot_list(self, name, repo=None):
+        from es_backup.repository import Repository
+        if repo is None:
+            repo = Repository(name)
+        snapshots = repo.list_snapshots(verbose=False)
         render_template('snapshot_list', repo=repo, snapshots=snapshots)
 
     def snapshot_details(self):
+        from es_backup.repository import Repository
+        from es_backup.snapshot import Snapshot
         parser = argparse.ArgumentParser(description='Show details of a '
                                          'snapshot')
         parser.add_argument('repo', help='Name of repository')
         parser.add_argument('snapshot', help='Name of snapshot')
-        args = parser.parse_args(sys.argv[2:])
-        repo = Repository(args.repo)
-        snapshot = Snapshot(args.snapshot, repo)
+        self.__offline_args(parser)
+        args = parser.parse_args(self.argv)
+        if args.offline:
+            repo = self.__offline_repo(parser, args, args.repo)
+            snapshot = repo.get_snapshot(args.snapshot)
+        else:
+            repo = Repository(args.repo)
+            snapshot = Snapshot(args.snapshot, repo)
         render_template('snapshot_details', snapshot=snapshot)
 
+    def __adaptive(self, args):
+        return self.__arg_conf(args.adaptive_rate,
+                               option('throttle', 'enabled', False,
+                                      'getboolean'))
+
+    def __group_args(self, parser):
+        parser.add_argument('-g', '--groups', type=int, help='Split indices '
+                            'into this many groups by store size and '
+                            'snapshot each group separately, waiting for '
+                            'them to finish (Default: 1)')
+        parser.add_argument('-m', '--max-concurrent', type=int, help='Number '
+                            'of group snapshots run at once (Default: 1)')
+        parser.add_argument('--group-retries', type=int, help='Times a '
+                            'failed group snapshot is retried (Default: 2)')
+
+    def __group_conf(self, args):
+        return {
+            'groups': self.__arg_conf(args.groups,
+                                      option('default', 'snapshot_groups',
+                                             1, 'getint')),
+            'max_concurrent': self.__arg_conf(args.max_concurrent,
+                                              option(
+                                                  'default',
+                                                  'max_concurrent_snapshots',
+                                                  1, 'getint')),
+            'retries': self.__arg_conf(args.group_retries,
+                                       option('default', 'group_retries',
+                                              2, 'getint'))
+        }
+
     def snapshot_create(self):
+        from es_backup.backup import create_sharded_backup, wait_for_backup
+        from es_backup.repository import Repository
+        from es_backup.snapshot import Snapshot
         parser = argparse.ArgumentParser(description='Create a snapshot')
         parser.add_argument('repo', help='Name of repository')
         parser.add_argument('snapshot', help='Name of snapshot')
@@ -206,7 +461,17 @@ Commands
         parser.add_argument('--partial', action='store_true', help='Permit '
                             'snapshot creation when not all primary shards '
                             'are available')
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('-w', '--wait', action='store_true', help='Wait '
+                            'for the snapshot to finish, reporting progress')
+        parser.add_argument('--summary-file', help='Append a JSON summary of '
+                            'the finished snapshot to this file (requires '
+                            '--wait)')
+        parser.add_argument('--adaptive-rate', action='store_true',
+                            default=None, help='Adjust the snapshot rate of '
+                            'the repository to the cluster load while '
+                            'waiting')
+        self.__group_args(parser)
+        args = parser.parse_args(self.argv)
         repo = Repository(args.repo)
 
         ign_unavail = self.__arg_conf(args.ignore_unavailable,
@@ -217,6 +482,20 @@ Commands
                                                     'include_global_state'))
         partial = self.__arg_conf(args.partial, config.get('default',
                                                            'partial'))
+        summary_file = self.__arg_conf(args.summary_file,
+                                       option('default', 'summary_file'))
+        grouping = self.__group_conf(args)
+
+        if grouping['groups'] > 1:
+            summary = create_sharded_backup(
+                repo, args.snapshot, args.indices,
+                ignore_unavailable=ign_unavail,
+                include_global_state=inc_glob_state, partial=partial,
+                summary_file=summary_file, adaptive=self.__adaptive(args),
+                **grouping)
+            if summary['state'] != 'SUCCESS':
+                sys.exit(1)
+            return
 
         snapshot = Snapshot(args.snapshot, repo, indices=args.indices,
                             ignore_unavailable=ign_unavail,
@@ -224,28 +503,155 @@ Commands
                             partial=partial)
         print('Snapshot %s created in repository %s' % (snapshot.name,
                                                         repo.name))
+        if args.wait:
+            summary = wait_for_backup(snapshot, summary_file=summary_file,
+                                      adaptive=self.__adaptive(args))
+            if summary['state'] != 'SUCCESS':
+                sys.exit(1)
 
     def snapshot_delete(self):
+        from es_backup.repository import Repository
+        from es_backup.snapshot import Snapshot
         parser = argparse.ArgumentParser(description='Delete a snapshot')
         parser.add_argument('repo', help='Name of repository')
         parser.add_argument('snapshot', help='Name of snapshot')
-        args = parser.parse_args(sys.argv[2:])
+        args = parser.parse_args(self.argv)
         repo = Repository(args.repo)
         snapshot = Snapshot(args.snapshot, repo)
         snapshot.delete()
         print('Snapshot %s deleted from repository %s' % (snapshot.name,
               repo.name))
 
+    def snapshot_restore(self):
+        from es_backup.progress import format_seconds
+        from es_backup.repository import Repository
+        from es_backup.restore import (RestoreError, restore_snapshot,
+                                       select_indices)
+        parser = argparse.ArgumentParser(description='Restore indices from '
+                                         'a snapshot')
+        parser.add_argument('repo', help='Name of repository')
+        parser.add_argument('snapshot', help='Name of snapshot')
+        parser.add_argument('-i', '--indices', help='Comma separated list of '
+                            'index names or wildcards to restore (Default: '
+                            'all indices of the snapshot)')
+        parser.add_argument('-p', '--priority', help='Comma separated list '
+                            'of index names or wildcards restored first, in '
+                            'order')
+        parser.add_argument('--rename-pattern', help='Regular expression '
+                            'matched against restored index names')
+        parser.add_argument('--rename-replacement', help='Replacement for '
+                            'the rename pattern (Example: restored_$1)')
+        parser.add_argument('-r', '--restore-rate', help='Max rate of '
+                            'restore for this restore only (Example: 200mb)')
+        parser.add_argument('-b', '--batch-size', type=int, help='Indices '
+                            'per restore request (Default: 5)')
+        parser.add_argument('-c', '--concurrency', type=int, help='Restore '
+                            'requests in progress at once (Default: 1)')
+        parser.add_argument('--ignore-unavailable', action='store_true',
+                            help='Skip indices missing from the snapshot')
+        parser.add_argument('--include-global-state', action='store_true',
+                            help='Restore the cluster global state')
+        parser.add_argument('--partial', action='store_true', help='Permit '
+                            'restoring indices with unavailable shards')
+        parser.add_argument('--adaptive-rate', action='store_true',
+                            default=None, help='Adjust the restore rate of '
+                            'the repository to the cluster load while '
+                            'restoring')
+        args = parser.parse_args(self.argv)
+        if bool(args.rename_pattern) != bool(args.rename_replacement):
+            print('--rename-pattern and --rename-replacement must be used '
+                  'together')
+            sys.exit(1)
+        repo = Repository(args.repo)
+        snapshot = repo.get_snapshot(args.snapshot)
+        if snapshot is None:
+            print('Snapshot %s not found in repository %s' % (args.snapshot,
+                                                              repo.name))
+            sys.exit(1)
+        patterns = args.indices.split(',') if args.indices else None
+        priority = args.priority.split(',') if args.priority else None
+        indices = select_indices(snapshot.indices.split(','), patterns,
+                                 priority)
+        if not indices:
+            print('No indices of snapshot %s match %s' % (snapshot.name,
+                                                          args.indices))
+            sys.exit(1)
+        batch_size = self.__arg_conf(args.batch_size,
+                                     option('default', 'restore_batch_size',
+                                            5, 'getint'))
+        concurrency = self.__arg_conf(args.concurrency,
+                                      option('default', 'restore_concurrency',
+                                             1, 'getint'))
+        try:
+            summary = restore_snapshot(
+                snapshot, indices, batch_size=batch_size,
+                concurrency=concurrency, rename_pattern=args.rename_pattern,
+                rename_replacement=args.rename_replacement,
+                restore_rate=args.restore_rate,
+                ignore_unavailable=args.ignore_unavailable,
+                include_global_state=args.include_global_state,
+                partial=args.partial, adaptive=self.__adaptive(args))
+        except RestoreError as error:
+            print(error)
+            sys.exit(1)
+        print('Restored %s indices from snapshot %s in %s, first usable '
+              'after %s' % (len(summary['indices']), snapshot.name,
+                            format_seconds(summary['duration']),
+                            format_seconds(summary['first_usable'])))
+
+    def __keep_args(self, parser):
+        parser.add_argument('--keep-last', type=int, help='Number of newest '
+                            'snapshots to keep')
+        parser.add_argument('--keep-hourly', type=int, help='Number of hours '
+                            'to keep the newest snapshot of')
+        parser.add_argument('--keep-daily', type=int, help='Number of days to '
+                            'keep the newest snapshot of')
+        parser.add_argument('--keep-weekly', type=int, help='Number of weeks '
+                            'to keep the newest snapshot of')
+
+    def __keep_conf(self, args):
+        return dict((rule, self.__arg_conf(getattr(args, rule),
+                                           option('backup', rule, 0,
+                                                  'getint')))
+                    for rule in ('keep_last', 'keep_hourly', 'keep_daily',
+                                 'keep_weekly'))
+
+    def snapshot_prune(self):
+        from es_backup.backup import prune_snapshots
+        from es_backup.repository import Repository
+        parser = argparse.ArgumentParser(description='Delete snapshots of a '
+                                         'repository not matched by the keep '
+                                         'rules, and every failed snapshot')
+        parser.add_argument('repo', help='Name of repository')
+        self.__keep_args(parser)
+        parser.add_argument('-b', '--batch-size', type=int, help='Maximum '
+                            'snapshots removed per delete request (Default: '
+                            '100)')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Only show the snapshots that would be '
+                            'deleted')
+        args = parser.parse_args(self.argv)
+        keep = self.__keep_conf(args)
+        if not any(keep.values()):
+            print('At least one keep rule must be set')
+            sys.exit(1)
+        batch_size = self.__arg_conf(args.batch_size,
+                                     option('backup', 'prune_batch_size',
+                                            100, 'getint'))
+        repo = Repository(args.repo)
+        prune_snapshots(repo, batch_size=batch_size, dry_run=args.dry_run,
+                        **keep)
+
     def scheduled_backup(self):
         parser = argparse.ArgumentParser(description='Create a backup '
                                          'according to configured schedule')
         parser.add_argument('-t', '--type', default='fs', choices=['fs', 's3',
                             'azure', 'hdfs'], help='Backup type')
-        parser.add_argument('-c', '--count', help='Full backup count to '
-                            'retain (Default: 4)')
-        parser.add_argument('-l', '--life', help='Life time of a backup in '
-                            'days before a new full backup will be taken '
-                            '(Default: 7)')
+        parser.add_argument('-c', '--count', type=int, help='Full backup '
+                            'count to retain (Default: 4)')
+        parser.add_argument('-l', '--life', type=int, help='Life time of a '
+                            'backup in days before a new full backup will '
+                            'be taken (Default: 7)')
         parser.add_argument('-b', '--base-path', help='Base path of backup '
                             'repositories (Default: '
                             '/var/backups/elasticsearch')
@@ -263,7 +669,45 @@ Commands
         parser.add_argument('--partial', action='store_true', help='Permit '
                             'snapshot creation when not all primary shards '
                             'are available')
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('-w', '--wait', action='store_true', help='Wait '
+                            'for the snapshot to finish, reporting progress')
+        parser.add_argument('--summary-file', help='Append a JSON summary of '
+                            'the finished snapshot to this file (requires '
+                            '--wait)')
+        parser.add_argument('--adaptive-rate', action='store_true',
+                            default=None, help='Adjust the snapshot rate of '
+                            'the repository to the cluster load while '
+                            'waiting')
+        self.__group_args(parser)
+        self.__keep_args(parser)
+        self.__cluster_args(parser)
+        parser.add_argument('--profile', action='store_true', help='Print '
+                            'the time spent in each phase of the backup')
+        args = parser.parse_args(self.argv)
+        clusters = self.__clusters(parser, args)
+        if clusters is None:
+            succeeded = self.__scheduled_backup(args)
+        else:
+            results = self.__fan_out(clusters, self.__scheduled_backup, args)
+            succeeded = all(result['error'] is None and result['result']
+                            for result in results)
+        if args.profile:
+            metrics.print_profile()
+        if not succeeded:
+            sys.exit(1)
+
+    def __scheduled_backup(self, args):
+        from es_backup.backup import lock_path
+        from es_backup.scheduler import job_lock
+        with job_lock(lock_path('snapshot')) as locked:
+            if not locked:
+                print('Scheduled backup already running, skipping')
+                return False
+            return self.__run_scheduled_backup(args)
+
+    def __run_scheduled_backup(self, args):
+        from es_backup.backup import (create_backup, get_backup_repo,
+                                      prune_snapshots, remove_old_backups)
         repo_type = self.__arg_conf(args.type, config.get('backup',
                                                           'backup_type'))
         count = self.__arg_conf(args.count, config.getint('backup',
@@ -283,12 +727,192 @@ Commands
                                                            'include_global_state'))
         partial = self.__arg_conf(args.partial, config.getboolean('default',
                                                                   'partial'))
+        summary_file = self.__arg_conf(args.summary_file,
+                                       option('default', 'summary_file'))
+
+        with metrics.phase('select-repository'):
+            backup = get_backup_repo(repo_type=repo_type, count=count,
+                                     life=life, base_path=path,
+                                     prefix=prefix)
+        with metrics.phase('snapshot'):
+            summary = create_backup(backup, indices=indices,
+                                    ignore_unavailable=ign_unavail,
+                                    include_global_state=inc_glob_state,
+                                    partial=partial, wait=args.wait,
+                                    summary_file=summary_file,
+                                    adaptive=self.__adaptive(args),
+                                    **self.__group_conf(args))
+        keep = self.__keep_conf(args)
+        if any(keep.values()):
+            with metrics.phase('prune'):
+                prune_snapshots(backup, batch_size=option(
+                                'backup', 'prune_batch_size', 100, 'getint'),
+                                **keep)
+        with metrics.phase('age-out'), self.__age_out_lock() as locked:
+            if locked:
+                remove_old_backups(prefix, count=count, life=life)
+            else:
+                print('Age-out or archive already running, skipping '
+                      'age-out')
+        return not summary or summary['state'] == 'SUCCESS'
+
+    def __age_out_lock(self):
+        from es_backup.backup import lock_path
+        from es_backup.scheduler import job_lock
+        return job_lock(lock_path('age-out'))
+
+    def age_out(self):
+        from es_backup.backup import remove_old_backups
+        parser = argparse.ArgumentParser(description='Remove backup '
+                                         'repositories older than the '
+                                         'configured retention')
+        parser.add_argument('-c', '--count', type=int, help='Full backup '
+                            'count to retain (Default: 4)')
+        parser.add_argument('-l', '--life', type=int, help='Life time of a '
+                            'backup in days (Default: 7)')
+        parser.add_argument('-p', '--prefix', help='Backup repository name '
+                            'prefix (Default: backup)')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Only show the repositories that would be '
+                            'removed')
+        args = parser.parse_args(self.argv)
+        count = self.__arg_conf(args.count, config.getint('backup',
+                                                          'full_backup_count'))
+        life = self.__arg_conf(args.life, config.getint('backup',
+                                                        'full_backup_life'))
+        prefix = self.__arg_conf(args.prefix, config.get('backup', 'prefix'))
+        with self.__age_out_lock() as locked:
+            if not locked:
+                print('Age-out or archive already running, skipping')
+                return
+            remove_old_backups(prefix, count=count, life=life,
+                               dry_run=args.dry_run)
+
+    def archive(self):
+        from es_backup.backup import archive_old_backups
+        parser = argparse.ArgumentParser(description='Unregister backup '
+                                         'repositories older than a number '
+                                         'of days and pack their files into '
+                                         'compressed archives')
+        parser.add_argument('-o', '--older-than', type=int, help='Age in '
+                            'days of the repositories to archive (Default: '
+                            '14)')
+        parser.add_argument('-p', '--prefix', help='Backup repository name '
+                            'prefix (Default: backup)')
+        parser.add_argument('-d', '--destination', help='Directory of the '
+                            'archives (Default: '
+                            '/var/backups/elasticsearch/archive)')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Only show the repositories that would be '
+                            'archived')
+        args = parser.parse_args(self.argv)
+        prefix = self.__arg_conf(args.prefix, config.get('backup', 'prefix'))
+        with self.__age_out_lock() as locked:
+            if not locked:
+                print('Age-out or archive already running, skipping')
+                return
+            archived, failed = archive_old_backups(
+                prefix, older_than=args.older_than,
+                destination=args.destination, dry_run=args.dry_run)
+        if failed:
+            print('Failed to archive %s' % ', '.join(failed))
+            sys.exit(1)
 
-        backup = get_backup_repo(repo_type=repo_type, count=count, life=life,
-                                 base_path=path, prefix=prefix)
-        create_backup(backup, indices=indices, ignore_unavailable=ign_unavail,
-                      include_global_state=inc_glob_state, partial=partial)
-        remove_old_backups(prefix)
+    def unarchive(self):
+        from es_backup.backup import restore_archived_backup
+        parser = argparse.ArgumentParser(description='Extract an archived '
+                                         'repository and register it again')
+        parser.add_argument('name', help='Name of repository')
+        parser.add_argument('-d', '--destination', help='Directory of the '
+                            'archives (Default: '
+                            '/var/backups/elasticsearch/archive)')
+        parser.add_argument('-l', '--location', help='Path to extract the '
+                            'repository to (Default: its location when '
+                            'archived)')
+        args = parser.parse_args(self.argv)
+        restore_archived_backup(args.name, destination=args.destination,
+                                location=args.location)
+
+    def cache_clear(self):
+        from es_backup.cache import cache
+        parser = argparse.ArgumentParser(description='Remove cached metadata '
+                                         'of the configured cluster')
+        parser.parse_args(self.argv)
+        cache.clear()
+        print('Metadata cache of %s cleared' % config.get('default',
+                                                           'base_url'))
+
+    def __job(self, section):
+        from es_backup.backup import JOB_TYPES, lock_path
+        from es_backup.clusters import (SECTION_PREFIX, cluster_names,
+                                        use_sections)
+        from es_backup.scheduler import Job
+        job_type = config.get(section, 'type')
+        if job_type not in JOB_TYPES:
+            print('Unknown type %s of %s' % (job_type, section))
+            sys.exit(1)
+        cluster = None
+        if config.has_option(section, 'cluster'):
+            cluster = config.get(section, 'cluster')
+            if cluster not in cluster_names():
+                print('Cluster %s of %s is not configured' % (cluster,
+                                                               section))
+                sys.exit(1)
+        sections = (section, SECTION_PREFIX + cluster if cluster else None)
+        func = JOB_TYPES[job_type]
+
+        def run():
+            with use_sections(*sections):
+                try:
+                    func()
+                finally:
+                    metrics.export()
+
+        with use_sections(*sections):
+            path = lock_path(job_type)
+        return Job(section[len('job:'):], config.get(section, 'schedule'),
+                   run, path)
+
+    def daemon(self):
+        from es_backup.scheduler import Scheduler
+        parser = argparse.ArgumentParser(description='Run the jobs of the '
+                                         '[job:<name>] config sections on '
+                                         'their schedules')
+        parser.add_argument('-w', '--workers', type=int, help='Number of '
+                            'jobs run at once (Default: 4)')
+        args = parser.parse_args(self.argv)
+        jobs = [self.__job(section) for section in config.sections()
+                if section.startswith('job:')]
+        if not jobs:
+            print('No jobs configured')
+            sys.exit(1)
+        workers = self.__arg_conf(args.workers,
+                                  option('daemon', 'workers', 4, 'getint'))
+        Scheduler(jobs, workers=workers).run()
+
+    def batch(self):
+        from es_backup.batch import run_batch
+        parser = argparse.ArgumentParser(description='Run commands read as '
+                                         'newline delimited JSON, writing '
+                                         'one JSON result per line')
+        parser.add_argument('-f', '--file', help='File to read commands '
+                            'from (Default: stdin)')
+        parser.add_argument('-p', '--parallelism', type=int, help='Number '
+                            'of commands run at once (Default: 4)')
+        args = parser.parse_args(self.argv)
+        workers = self.__arg_conf(args.parallelism,
+                                  option('default', 'batch_workers', 4,
+                                         'getint'))
+        source = open(args.file) if args.file else sys.stdin
+        try:
+            failed = run_batch(iter(source.readline, ''),
+                               lambda argv: Commands(argv, export=False),
+                               workers=workers)
+        finally:
+            if args.file:
+                source.close()
+        if failed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from es_backup.retention import rmtree
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+MANIFEST = 'manifest.json'
+BUFFER_SIZE = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _HashingFile(object):
+    """File wrapper keeping a sha256 and byte count of everything read from
+    or written to it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def walk_files(location):
+    """Yield (path relative to location, size) of every regular file below
+    location. Files and directories removed during the walk are left
+    out."""
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            entries = list(scandir(os.path.join(location, relative)))
+        except OSError as error:
+            if error.errno != errno.ENOENT or not relative:
+                raise
+            continue
+        for entry in entries:
+            path = os.path.join(relative, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield path, entry.stat(follow_symlinks=False).st_size
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+
+def plan_chunks(files, chunk_size):
+    """Group (path, size) files into chunks of about chunk_size bytes, in
+    walk order so the files of a shard mostly share a chunk. A file larger
+    than chunk_size gets a chunk of its own."""
+    chunks = []
+    current = []
+    current_size = 0
+    for path, size in files:
+        if current and current_size + size > chunk_size:
+            chunks.append(current)
+            current = []
+            current_size = 0
+        current.append(path)
+        current_size += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _chunk_name(index):
+    return 'chunk-%05d.tar.gz' % index
+
+
+def _pack_chunk(job):
+    """Write the files of one chunk to a gzip compressed tar archive,
+    streaming each file, and return the manifest entry of the chunk."""
+    location, path, index, files, level = job
+    name = _chunk_name(index)
+    target = os.path.join(path, name)
+    with open(target + '.tmp', 'wb') as raw:
+        output = _HashingFile(raw)
+        archive = tarfile.open(fileobj=output, mode='w:gz',
+                               compresslevel=level)
+        try:
+            for relative in files:
+                archive.add(os.path.join(location, relative),
+                            arcname=relative, recursive=False)
+        finally:
+            archive.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.rename(target + '.tmp', target)
+    return {'file': name, 'files': len(files), 'size': output.size,
+            'sha256': output.sha256.hexdigest()}
+
+
+def _check_member(member):
+    name = member.name
+    if (os.path.isabs(name) or '..' in name.split('/') or
+            not (member.isfile() or member.isdir())):
+        raise ArchiveError('Refusing to extract %s' % name)
+
+
+def _unpack_chunk(job):
+    """Extract one chunk into location while checking its sha256, and
+    return the number of files and bytes extracted."""
+    path, location, chunk = job
+    files = 0
+    size = 0
+    with open(os.path.join(path, chunk['file']), 'rb') as raw:
+        source = _HashingFile(raw)
+        archive = tarfile.open(fileobj=source, mode='r|gz')
+        try:
+            for member in archive:
+                _check_member(member)
+                archive.extract(member, location)
+                if member.isfile():
+                    files += 1
+                    size += member.size
+        finally:
+            archive.close()
+        while source.read(BUFFER_SIZE):
+            pass
+    if source.sha256.hexdigest() != chunk['sha256']:
+        raise ArchiveError('Checksum mismatch in %s' % chunk['file'])
+    return files, size
+
+
+def _write_manifest(path, manifest):
+    fd, temp = tempfile.mkstemp(dir=path, prefix='.manifest-')
+    with os.fdopen(fd, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(temp, os.path.join(path, MANIFEST))
+
+
+def read_manifest(destination, name):
+    path = os.path.join(destination, name, MANIFEST)
+    if not os.path.exists(path):
+        raise ArchiveError('No archive of %s in %s' % (name, destination))
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def archived_repos(destination):
+    """Return the names of the repositories archived under destination."""
+    if not os.path.isdir(destination):
+        return []
+    return sorted(entry.name for entry in scandir(destination)
+                  if os.path.exists(os.path.join(entry.path, MANIFEST)))
+
+
+def archive_repo(repo, destination, chunk_size=1024 ** 3, level=6,
+                 workers=4, rmtree_workers=16, keep_source=False):
+    """Unregister a file repository and pack its location into gzip
+    compressed tar chunks of about chunk_size bytes under
+    destination/<name>, compressed by workers processes.
+
+    The manifest, holding the repository registration and the checksum of
+    each chunk, is written last. If packing fails, the chunks written so
+    far are removed and the repository is registered again while its
+    location is still there. The location is removed afterwards unless
+    keep_source. Returns the manifest.
+    """
+    path = os.path.join(destination, repo.name)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        raise ArchiveError('Repository %s is already archived in %s' % (
+                           repo.name, path))
+    registration = repo.get_settings()
+    repo.unregister()
+    created = not os.path.isdir(path)
+    try:
+        if created:
+            os.makedirs(path)
+        files = list(walk_files(repo.location))
+        chunks = plan_chunks(files, chunk_size)
+        pool = Pool(max(1, min(workers, len(chunks))))
+        try:
+            packed = pool.map(_pack_chunk,
+                              [(repo.location, path, i, chunk, level)
+                               for i, chunk in enumerate(chunks)])
+        finally:
+            pool.close()
+            pool.join()
+        manifest = {'name': repo.name, 'location': repo.location,
+                    'repository': registration,
+                    'archived': datetime.now().isoformat(),
+                    'files': len(files),
+                    'bytes': sum(size for relative, size in files),
+                    'chunks': packed}
+        _write_manifest(path, manifest)
+    except BaseException:
+        if created:
+            shutil.rmtree(path, ignore_errors=True)
+        if os.path.isdir(repo.location):
+            repo.register(registration)
+        raise
+    if not keep_source:
+        pool = ThreadPool(rmtree_workers)
+        try:
+            rmtree(repo.location, pool)
+        finally:
+            pool.close()
+            pool.join()
+    return manifest
+
+
+def unarchive_repo(name, destination, location=None, workers=4):
+    """Extract the archive of repository name from destination into its
+    original location, or location if given, checking every chunk, and
+    return the manifest with the location used."""
+    manifest = read_manifest(destination, name)
+    location = location or manifest['location']
+    if os.path.isdir(location) and os.listdir(location):
+        raise ArchiveError('Location %s is not empty' % location)
+    if not os.path.isdir(location):
+        os.makedirs(location)
+    path = os.path.join(destination, name)
+    pool = Pool(max(1, min(workers, len(manifest['chunks']))))
+    try:
+        results = pool.map(_unpack_chunk, [(path, location, chunk)
+                                           for chunk in manifest['chunks']])
+    finally:
+        pool.close()
+        pool.join()
+    files = sum(result[0] for result in results)
+    size = sum(result[1] for result in results)
+    if (files, size) != (manifest['files'], manifest['bytes']):
+        raise ArchiveError('Extracted %s files of %s bytes from %s, '
+                           'expected %s files of %s bytes' % (
+                               files, size, path, manifest['files'],
+                               manifest['bytes']))
+    manifest['location'] = location
+    return manifest
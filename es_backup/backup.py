@@ -1,7 +1,19 @@
 from datetime import *
+import os
 from dateutil.parser import *
+from es_backup.archive import (ArchiveError, archive_repo, archived_repos,
+                               unarchive_repo)
+from es_backup.clusters import current_cluster
+from es_backup.config import option
+from es_backup.progress import (MB, format_bytes, format_seconds,
+                                wait_for_snapshot, write_summary)
 from es_backup.repository import *
+from es_backup.retention import remove_repos, select_snapshots
+from es_backup.sharding import list_indices, pack_indices, snapshot_groups
 from es_backup.snapshot import *
+from es_backup.throttle import adaptive_rate, parse_rate
+
+ARCHIVE_PATH = '/var/backups/elasticsearch/archive'
 
 
 def get_backup_repo(repo_type, count, life, base_path, prefix):
@@ -25,24 +37,303 @@ def get_backup_repo(repo_type, count, life, base_path, prefix):
         return repos[0]
 
 
+def wait_for_backup(snapshot, summary_file=None, adaptive=False):
+    with adaptive_rate(snapshot.repo, 'max_snapshot_bytes_per_sec',
+                       enabled=adaptive):
+        summary = wait_for_snapshot(snapshot)
+    print('Snapshot %s in repository %s finished %s in %s: %s, %s MB/s, '
+          '%s/%s shards failed' % (snapshot.name, snapshot.repo.name,
+                                   summary['state'],
+                                   format_seconds(summary['duration']),
+                                   format_bytes(summary['bytes']),
+                                   summary['mb_per_sec'],
+                                   summary['shards_failed'],
+                                   summary['shards_total']))
+    if summary_file:
+        write_summary(summary, summary_file)
+    return summary
+
+
+def create_sharded_backup(repo, name, indices, groups, max_concurrent,
+                          retries, ignore_unavailable, include_global_state,
+                          partial, summary_file=None, adaptive=False):
+    started = datetime.now()
+    sizes = list_indices(indices)
+    packed = pack_indices(sizes, groups)
+    if not packed:
+        print('No open indices match %s' % indices)
+    for i, group in enumerate(packed):
+        print('Group %s: %s indices, %s' % (
+              i + 1, len(group),
+              format_bytes(sum(sizes[index] for index in group))))
+    with adaptive_rate(repo, 'max_snapshot_bytes_per_sec', enabled=adaptive):
+        results = snapshot_groups(repo, name, packed,
+                                  max_concurrent=max_concurrent,
+                                  retries=retries,
+                                  ignore_unavailable=ignore_unavailable,
+                                  include_global_state=include_global_state,
+                                  partial=partial)
+    duration = (datetime.now() - started).total_seconds()
+    total = sum(result['bytes'] for result in results)
+    failed = [result['snapshot'] for result in results
+              if result['state'] != 'SUCCESS']
+    summary = {
+        'timestamp': started.isoformat(),
+        'repository': repo.name,
+        'snapshot': name,
+        'state': 'FAILED' if failed or not results else 'SUCCESS',
+        'duration': round(duration, 3),
+        'bytes': total,
+        'files': sum(result['files'] for result in results),
+        'mb_per_sec': round(total / MB / duration, 2) if duration else None,
+        'shards_total': sum(result['shards_total'] for result in results),
+        'shards_failed': sum(result['shards_failed'] for result in results),
+        'failed_groups': failed,
+        'groups': results
+    }
+    print('Snapshot %s in repository %s finished %s in %s: %s, %s MB/s, '
+          '%s of %s groups failed' % (name, repo.name, summary['state'],
+                                      format_seconds(duration),
+                                      format_bytes(total),
+                                      summary['mb_per_sec'], len(failed),
+                                      len(results)))
+    if summary_file:
+        write_summary(summary, summary_file)
+    return summary
+
+
 def create_backup(repo, indices, ignore_unavailable, include_global_state,
-                  partial):
+                  partial, wait=False, summary_file=None, groups=1,
+                  max_concurrent=1, retries=0, adaptive=False):
     name = datetime.now().strftime('%Y%m%d_%H:%M:%S')
+    if groups > 1:
+        return create_sharded_backup(repo, name, indices, groups,
+                                     max_concurrent, retries,
+                                     ignore_unavailable=ignore_unavailable,
+                                     include_global_state=include_global_state,
+                                     partial=partial,
+                                     summary_file=summary_file,
+                                     adaptive=adaptive)
     snapshot = Snapshot(name, repo, indices=indices,
                         ignore_unavailable=ignore_unavailable,
                         include_global_state=include_global_state,
                         partial=partial)
     print('Snapshot %s created in repository %s' % (snapshot.name, repo.name))
+    if wait:
+        return wait_for_backup(snapshot, summary_file=summary_file,
+                               adaptive=adaptive)
 
 
-def remove_old_backups(prefix):
-    full_count = config.getint('backup', 'full_backup_count')
-    life = config.getint('backup', 'full_backup_life')
-    max_age = full_count * life
+def remove_old_backups(prefix, count=None, life=None, dry_run=False):
+    if count is None:
+        count = config.getint('backup', 'full_backup_count')
+    if life is None:
+        life = config.getint('backup', 'full_backup_life')
+    max_age = count * life
     backup_repos = list_repos(match=('%s_[0-9]{8}' % prefix))
-    for backup in backup_repos:
+    expired = []
+    for backup in sorted(backup_repos, key=lambda repo: repo.name):
         date = parse(backup.name.split('_')[-1])
         age = (datetime.today() - date).days
         if age > max_age:
-            print('Aging out backup repository %s' % backup.name)
-            backup.delete()
+            print('%s backup repository %s (%s days old) at %s' % (
+                  'Would age out' if dry_run else 'Aging out', backup.name,
+                  age, getattr(backup, 'location', None)))
+            expired.append(backup)
+
+    report = remove_repos(expired,
+                          workers=option('backup', 'retention_workers', 4,
+                                         'getint'),
+                          rmtree_workers=option('backup', 'rmtree_workers',
+                                                16, 'getint'),
+                          dry_run=dry_run)
+    if dry_run:
+        return report
+    errors = []
+    for entry in report:
+        if entry['error'] is not None:
+            errors.append(entry['error'])
+            print('Failed to age out %s: %s' % (entry['name'],
+                                                 entry['error']))
+        else:
+            print('Aged out %s: unregistered in %.2fs, %s files deleted in '
+                  '%.2fs' % (entry['name'], entry['unregister'],
+                             entry['files'], entry['delete']))
+    if errors:
+        raise errors[0]
+    return report
+
+
+def archive_old_backups(prefix, older_than=None, destination=None,
+                        dry_run=False):
+    """Archive the backup repositories older than older_than days (see
+    archive.archive_repo) one after another, each compressed by the
+    configured number of processes. The newest backup repository, which
+    scheduled backups still write to, and repositories unarchived earlier
+    are skipped. Returns the manifests of the archived repositories and
+    the names of those that failed."""
+    if older_than is None:
+        older_than = option('archive', 'older_than', 14, 'getint')
+    if destination is None:
+        destination = option('archive', 'path', ARCHIVE_PATH)
+    backup_repos = list_repos(match=('%s_[0-9]{8}' % prefix))
+    existing = archived_repos(destination)
+    archived = []
+    failed = []
+    for backup in sorted(backup_repos, key=lambda repo: repo.name)[:-1]:
+        age = (datetime.today() - parse(backup.name.split('_')[-1])).days
+        if age <= older_than or getattr(backup, 'type', None) != 'fs':
+            continue
+        if backup.name in existing:
+            print('Skipping backup repository %s, it was unarchived from '
+                  '%s' % (backup.name, destination))
+            continue
+        print('%s backup repository %s (%s days old) at %s to %s' % (
+              'Would archive' if dry_run else 'Archiving', backup.name, age,
+              backup.location, destination))
+        if dry_run:
+            continue
+        started = datetime.now()
+        try:
+            manifest = archive_repo(
+                backup, destination,
+                chunk_size=parse_rate(option('archive', 'chunk_size',
+                                             '1gb')),
+                level=option('archive', 'compress_level', 6, 'getint'),
+                workers=option('archive', 'workers', 4, 'getint'),
+                rmtree_workers=option('backup', 'rmtree_workers', 16,
+                                      'getint'),
+                keep_source=option('archive', 'keep_source', False,
+                                   'getboolean'))
+        except Exception as error:
+            failed.append(backup.name)
+            print('Failed to archive %s: %s' % (backup.name, error))
+            continue
+        packed = sum(chunk['size'] for chunk in manifest['chunks'])
+        print('Archived %s: %s files, %s packed into %s chunks of %s in '
+              '%s' % (backup.name, manifest['files'],
+                      format_bytes(manifest['bytes']),
+                      len(manifest['chunks']), format_bytes(packed),
+                      format_seconds((datetime.now() -
+                                      started).total_seconds())))
+        archived.append(manifest)
+    return archived, failed
+
+
+def restore_archived_backup(name, destination=None, location=None):
+    """Extract an archived backup repository and register it again with
+    the settings it had when archived."""
+    if destination is None:
+        destination = option('archive', 'path', ARCHIVE_PATH)
+    if name in [repo.name for repo in list_repos()]:
+        raise ArchiveError('Repository %s is registered' % name)
+    started = datetime.now()
+    manifest = unarchive_repo(name, destination, location=location,
+                              workers=option('archive', 'workers', 4,
+                                             'getint'))
+    registration = manifest['repository']
+    registration['settings']['location'] = manifest['location']
+    Repository(name).register(registration)
+    print('Unarchived %s: %s files, %s at %s in %s' % (
+          name, manifest['files'], format_bytes(manifest['bytes']),
+          manifest['location'],
+          format_seconds((datetime.now() - started).total_seconds())))
+    return manifest
+
+
+def prune_snapshots(repo, keep_last=0, keep_hourly=0, keep_daily=0,
+                    keep_weekly=0, batch_size=100, dry_run=False):
+    keep, delete = select_snapshots(repo.list_snapshots(),
+                                    keep_last=keep_last,
+                                    keep_hourly=keep_hourly,
+                                    keep_daily=keep_daily,
+                                    keep_weekly=keep_weekly)
+    for snapshot in delete:
+        print('%s snapshot %s (%s) from repository %s' % (
+              'Would prune' if dry_run else 'Pruning', snapshot.name,
+              snapshot.state, repo.name))
+    if delete and not dry_run:
+        repo.delete_snapshots(delete, batch_size=batch_size)
+    print('Kept %s snapshots, %s %s from repository %s' % (
+          len(keep), 'would prune' if dry_run else 'pruned', len(delete),
+          repo.name))
+    return keep, delete
+
+
+# Job types sharing a lock. Archive and age-out both unregister and
+# remove old backup repositories, so they never run at the same time.
+SHARED_LOCKS = {'archive': 'age-out'}
+
+
+def lock_path(job_type):
+    path = os.path.expanduser(option('daemon', 'lock_path',
+                                     '~/.cache/es-backup/locks'))
+    return os.path.join(path, '%s-%s.lock' % (
+                        current_cluster() or 'default',
+                        SHARED_LOCKS.get(job_type, job_type)))
+
+
+def backup_job():
+    repo_type = config.get('backup', 'backup_type')
+    prefix = config.get('backup', 'prefix')
+    backup = get_backup_repo(repo_type=repo_type,
+                             count=config.getint('backup',
+                                                 'full_backup_count'),
+                             life=config.getint('backup', 'full_backup_life'),
+                             base_path=config.get(repo_type,
+                                                  'backup_base_path'),
+                             prefix=prefix)
+    summary = create_backup(
+        backup, indices=config.get('backup', 'indices'),
+        ignore_unavailable=config.getboolean('default', 'ignore_unavailable'),
+        include_global_state=config.getboolean('default',
+                                               'include_global_state'),
+        partial=config.getboolean('default', 'partial'),
+        wait=option('backup', 'wait', True, 'getboolean'),
+        summary_file=option('default', 'summary_file'),
+        groups=option('default', 'snapshot_groups', 1, 'getint'),
+        max_concurrent=option('default', 'max_concurrent_snapshots', 1,
+                              'getint'),
+        retries=option('default', 'group_retries', 2, 'getint'),
+        adaptive=option('throttle', 'enabled', False, 'getboolean'))
+    if summary and summary['state'] != 'SUCCESS':
+        raise RuntimeError('Snapshot %s finished %s' % (summary['snapshot'],
+                                                        summary['state']))
+
+
+def prune_job():
+    if config.has_option('backup', 'repository'):
+        repo = Repository(config.get('backup', 'repository'))
+    else:
+        prefix = config.get('backup', 'prefix')
+        repos = sorted(list_repos(match=('%s_[0-9]{8}' % prefix)),
+                       key=lambda repo: repo.name, reverse=True)
+        if not repos:
+            print('No backup repository with prefix %s to prune' % prefix)
+            return
+        repo = repos[0]
+    prune_snapshots(repo,
+                    keep_last=option('backup', 'keep_last', 0, 'getint'),
+                    keep_hourly=option('backup', 'keep_hourly', 0, 'getint'),
+                    keep_daily=option('backup', 'keep_daily', 0, 'getint'),
+                    keep_weekly=option('backup', 'keep_weekly', 0, 'getint'),
+                    batch_size=option('backup', 'prune_batch_size', 100,
+                                      'getint'))
+
+
+def age_out_job():
+    remove_old_backups(config.get('backup', 'prefix'))
+
+
+def archive_job():
+    archived, failed = archive_old_backups(config.get('backup', 'prefix'))
+    if failed:
+        raise RuntimeError('Failed to archive %s' % ', '.join(failed))
+
+
+JOB_TYPES = {
+    'snapshot': backup_job,
+    'prune': prune_job,
+    'age-out': age_out_job,
+    'archive': archive_job
+}
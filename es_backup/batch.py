@@ -0,0 +1,158 @@
+import json
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from es_backup.clusters import ThreadOutput, cluster_names, use_cluster
+
+NOT_BATCHABLE = ('batch', 'daemon')
+# Commands that create, prune or remove repositories of their own choosing
+CLUSTER_WIDE = ('age-out', 'archive', 'scheduled-backup')
+
+
+class BatchError(Exception):
+    pass
+
+
+def to_argv(request):
+    """Translate a batch request into the argument list of its command.
+
+    A request names the command and optionally lists positional args and
+    options by long option name: {"command": "snapshot-create", "args":
+    ["repo", "snap"], "options": {"wait": true, "indices": "logs-*"}}.
+    True adds a flag, false and null leave the option out and lists repeat
+    it.
+    """
+    if not isinstance(request, dict) or not request.get('command'):
+        raise BatchError('Request must be an object with a command')
+    if request['command'] in NOT_BATCHABLE:
+        raise BatchError('%s can not run in a batch' % request['command'])
+    argv = [request['command']]
+    argv.extend('%s' % arg for arg in request.get('args', []))
+    for name, value in sorted(request.get('options', {}).items()):
+        option = '--%s' % name.replace('_', '-')
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            if value is True:
+                argv.append(option)
+            elif value is not None and value is not False:
+                argv.extend([option, '%s' % value])
+    return argv
+
+
+def request_key(request, argv):
+    """Requests with the same key run one after another in input order:
+    those of a repository, and those of a command without a repository,
+    per cluster. A key of None marks a CLUSTER_WIDE request, which runs
+    after and before every other request of its cluster."""
+    command = argv[0]
+    if command in CLUSTER_WIDE:
+        return None
+    if command.startswith(('repo-', 'snapshot-')) and len(argv) > 1:
+        target = argv[1]
+        if command == 'repo-create' and len(argv) > 2:
+            target = argv[2]
+        return (request.get('cluster'), target)
+    return (request.get('cluster'), command)
+
+
+def _run(job):
+    run, number, request, argv, previous, done, output, errors = job
+    for event in previous:
+        event.wait()
+    started = time.time()
+    result = {'id': request.get('id', number), 'command': argv[0],
+              'exit_code': 0, 'error': None}
+    output.capture()
+    errors.capture()
+    try:
+        with use_cluster(request.get('cluster')):
+            run(argv)
+    except SystemExit as error:
+        code = error.code
+        if code is not None and not isinstance(code, int):
+            result['error'] = str(code)
+            code = 1
+        result['exit_code'] = code or 0
+    except Exception as error:
+        result['exit_code'] = 1
+        result['error'] = '%s: %s' % (type(error).__name__, error)
+    finally:
+        result['output'] = output.release()
+        result['stderr'] = errors.release()
+        result['duration'] = round(time.time() - started, 3)
+        done.set()
+    return result
+
+
+def run_batch(lines, run, workers=4, stream=None):
+    """Run newline delimited JSON requests with run(argv), at most workers
+    at once, writing one JSON result per request to stream as they finish.
+
+    Requests are read as they arrive; those naming a cluster that is not
+    configured fail without running. Requests sharing a key (see
+    request_key) wait for the one before them, and CLUSTER_WIDE requests
+    wait for all requests of their cluster before them and hold back all
+    that follow. Returns the number of failed requests.
+    """
+    stream = stream or sys.stdout
+    lock = threading.Lock()
+    failed = [0]
+
+    def write(result):
+        with lock:
+            if result['exit_code'] or result['error']:
+                failed[0] += 1
+            stream.write(json.dumps(result, sort_keys=True) + '\n')
+            stream.flush()
+
+    output = ThreadOutput(sys.stdout)
+    errors = ThreadOutput(sys.stderr)
+    clusters = cluster_names()
+    last = {}
+    barriers = {}
+    running = {}
+    pending = []
+    pool = ThreadPool(max(1, workers))
+    sys.stdout, sys.stderr = output, errors
+    try:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                argv = to_argv(request)
+                cluster = request.get('cluster')
+                if cluster is not None and cluster not in clusters:
+                    raise BatchError('Cluster %s is not configured' %
+                                     cluster)
+            except (ValueError, BatchError) as error:
+                request = request if isinstance(request, dict) else {}
+                write({'id': request.get('id', number), 'command': None,
+                       'exit_code': 1, 'error': str(error), 'output': '',
+                       'stderr': '', 'duration': 0})
+                continue
+            key = request_key(request, argv)
+            done = threading.Event()
+            previous = [barriers[cluster]] if cluster in barriers else []
+            if key is None:
+                previous.extend(running.pop(cluster, []))
+                barriers[cluster] = done
+            else:
+                if key in last:
+                    previous.append(last[key])
+                running[cluster] = [event for event in
+                                    running.get(cluster, [])
+                                    if not event.is_set()] + [done]
+                last[key] = done
+            pending.append(pool.apply_async(
+                _run, ((run, number, request, argv, previous, done,
+                        output, errors),), callback=write))
+        pool.close()
+        for job in pending:
+            job.wait()
+    finally:
+        sys.stdout, sys.stderr = output.stream, errors.stream
+        pool.terminate()
+    return failed[0]
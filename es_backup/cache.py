@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from es_backup.config import config, option
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+COMPLETED_STATES = ('SUCCESS', 'PARTIAL', 'FAILED', 'INCOMPATIBLE')
+
+
+def snapshot_keys(repo, *names):
+    """Keys of the snapshot listings of repo and of the given snapshots."""
+    keys = ['snapshots/%s' % repo.name, 'snapshot-names/%s' % repo.name]
+    if names and repo.uuid:
+        keys.extend(repo.snapshot_key(name, fetch=True) for name in names)
+    return keys
+
+
+class MetadataCache(object):
+    """Metadata of repositories and snapshots kept on disk between runs, in
+    one JSON file per key under a directory per cluster base_url.
+
+    Every entry expires ttl seconds after it was stored; the expiry is kept
+    as the mtime of its file. Entries are written to a temporary file and
+    renamed in place and invalidated by removing their file, so processes
+    sharing the cache only ever replace the keys they change. Expired files
+    are removed at most once per ttl by the process storing an entry.
+    """
+
+    def __init__(self, path, ttl=300, enabled=True):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.enabled = enabled
+        self.__swept = {}
+        self.__lock = threading.Lock()
+
+    def __directory(self):
+        base_url = config.get('default', 'base_url')
+        digest = hashlib.sha1(base_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest)
+
+    def __file(self, key):
+        parts = [quote(part.encode('utf-8'), safe='')
+                 for part in key.split('/')]
+        return os.path.join(self.__directory(), *parts) + '.json'
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self.__file(key)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                return None
+            with open(path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, data, ttl=True):
+        self.update({key: data}, ttl=ttl)
+
+    def update(self, items, ttl=True):
+        """Store several entries. ttl True uses the default ttl."""
+        if not self.enabled:
+            return
+        if ttl is True:
+            ttl = self.ttl
+        expires = time.time() + ttl
+        for key, data in items.items():
+            path = self.__file(key)
+            try:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                fd, temp_path = tempfile.mkstemp(dir=directory,
+                                                 prefix='.entry-')
+                with os.fdopen(fd, 'w') as cache_file:
+                    json.dump(data, cache_file)
+                os.utime(temp_path, (expires, expires))
+                os.rename(temp_path, path)
+            except (IOError, OSError):
+                pass
+        self.__sweep()
+
+    def __sweep(self):
+        directory = self.__directory()
+        now = time.time()
+        with self.__lock:
+            if self.__swept.get(directory, 0) > now - self.ttl:
+                return
+            self.__swept[directory] = now
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < now:
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+    def invalidate(self, *keys, **kwargs):
+        """Drop the given keys and every key below prefix, which ends
+        with /."""
+        if not self.enabled:
+            return
+        for key in keys:
+            try:
+                os.unlink(self.__file(key))
+            except OSError:
+                pass
+        prefix = kwargs.get('prefix')
+        if prefix:
+            shutil.rmtree(os.path.dirname(self.__file(prefix)),
+                          ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.__directory(), ignore_errors=True)
+
+
+cache = MetadataCache(option('cache', 'path', '~/.cache/es-backup'),
+                      ttl=option('cache', 'ttl', 300, 'getint'),
+                      enabled=option('cache', 'enabled', True, 'getboolean'))
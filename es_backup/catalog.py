@@ -0,0 +1,197 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime
+from es_backup import smile
+
+CODEC_MAGIC = 0x3FD76C17
+FOOTER_LENGTH = 16
+DEFLATE_HEADER = b'DFL\x00'
+SNAPSHOT_STATES = {0: 'IN_PROGRESS', 1: 'SUCCESS', 2: 'FAILED', 3: 'PARTIAL',
+                   4: 'INCOMPATIBLE'}
+
+
+class CatalogError(Exception):
+    pass
+
+
+def _read_vint(data, pos):
+    value, shift = 0, 0
+    while True:
+        b = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def map_file(path):
+    """Return a read-only memory map of path, or an empty string for empty
+    files which cannot be mapped."""
+    with open(path, 'rb') as blob:
+        if os.fstat(blob.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_content(data):
+    """Decode JSON or smile content, inflating it first when compressed."""
+    if data[:4] == DEFLATE_HEADER:
+        data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data[4:])
+    if data[:3] == smile.HEADER:
+        return smile.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def read_blob(path):
+    """Read a metadata blob, stripping the lucene codec header and footer
+    that snapshot blobs are wrapped in."""
+    data = map_file(path)
+    try:
+        if len(data) >= 4 and struct.unpack('>I', data[:4])[0] == CODEC_MAGIC:
+            length, pos = _read_vint(data, 4)
+            start = pos + length + 4
+            return decode_content(data[start:len(data) - FOOTER_LENGTH])
+        return decode_content(data[:])
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _millis(value):
+    if not value:
+        return None
+    from dateutil.tz import tzutc
+    return datetime.fromtimestamp(value / 1000.0, tzutc())
+
+
+class OfflineSnapshot(object):
+    """Snapshot read from the repository on disk. The entry of the
+    repository index provides the name and state; the snapshot blob is only
+    decoded when any other attribute is accessed."""
+
+    def __init__(self, repo, entry, indices):
+        self.repo = repo
+        self.name = entry['name']
+        self.uuid = entry.get('uuid', entry['name'])
+        self.__state = entry.get('state')
+        self.__indices = indices
+        self.__loaded = False
+
+    def __str__(self):
+        return 'Snapshot %s of repo %s' % (self.name, self.repo.name)
+
+    @property
+    def state(self):
+        if isinstance(self.__state, int):
+            return SNAPSHOT_STATES.get(self.__state, self.__state)
+        if self.__state is None:
+            self.__load()
+        return self.__state
+
+    def __load(self):
+        if self.__loaded:
+            return
+        self.__loaded = True
+        path = os.path.join(self.repo.location, 'snap-%s.dat' % self.uuid)
+        if not os.path.exists(path):
+            raise CatalogError('Snapshot blob %s not found' % path)
+        snapshot = read_blob(path).get('snapshot', {})
+        self.__state = snapshot.get('state', self.__state)
+        self.__indices = snapshot.get('indices', self.__indices)
+        self.start_time = _millis(snapshot.get('start_time'))
+        self.end_time = _millis(snapshot.get('end_time'))
+        if self.start_time and self.end_time:
+            self.duration = (snapshot['end_time'] -
+                             snapshot['start_time']) / 1000.0
+        self.failures = snapshot.get('failures', [])
+        total = snapshot.get('total_shards', 0)
+        successful = snapshot.get('successful_shards', 0)
+        self.shards = {'total': total, 'successful': successful,
+                       'failed': total - successful}
+
+    @property
+    def indices(self):
+        if not self.__indices:
+            self.__load()
+        return ','.join(self.__indices) or '_all'
+
+    def __getattr__(self, name):
+        if name.startswith('_') or self.__loaded:
+            raise AttributeError(name)
+        self.__load()
+        return getattr(self, name)
+
+
+class OfflineRepository(object):
+    """Read only view of an fs repository from its location on disk,
+    without going through elasticsearch."""
+
+    def __init__(self, name, location):
+        self.name = name
+        self.type = 'fs'
+        self.location = location
+        self.compress = None
+        self.chunk_size = None
+        self.restore_rate = None
+        self.snapshot_rate = None
+        self.__data = None
+
+    def __str__(self):
+        return 'repo %s - location: %s' % (self.name, self.location)
+
+    @property
+    def generation(self):
+        latest = os.path.join(self.location, 'index.latest')
+        if os.path.exists(latest):
+            with open(latest, 'rb') as blob:
+                return struct.unpack('>q', blob.read(8))[0]
+        generations = [int(name[6:]) for name in os.listdir(self.location)
+                       if name.startswith('index-') and name[6:].isdigit()]
+        if not generations:
+            raise CatalogError('No repository index found in %s' %
+                               self.location)
+        return max(generations)
+
+    @property
+    def data(self):
+        if self.__data is None:
+            self.__data = read_blob(os.path.join(
+                self.location, 'index-%s' % self.generation))
+        return self.__data
+
+    def __snapshot_indices(self):
+        indices = {}
+        for index, entry in self.data.get('indices', {}).items():
+            for uuid in entry.get('snapshots', []):
+                indices.setdefault(uuid, []).append(index)
+        return indices
+
+    def __entries(self):
+        for entry in self.data.get('snapshots', []):
+            if not isinstance(entry, dict):
+                entry = {'name': entry}
+            yield entry
+
+    def list_snapshots(self, verbose=True):
+        """Yield the snapshots of the repository. Snapshot blobs are read
+        lazily either way, so verbose has no effect."""
+        indices = self.__snapshot_indices()
+        for entry in self.__entries():
+            yield OfflineSnapshot(self, entry,
+                                  sorted(indices.get(entry.get('uuid'), [])))
+
+    def get_snapshot(self, name):
+        for entry in self.__entries():
+            if entry['name'] == name:
+                indices = self.__snapshot_indices()
+                return OfflineSnapshot(self, entry,
+                                       sorted(indices.get(entry.get('uuid'),
+                                                          [])))
+        raise CatalogError('Snapshot %s not found in %s' % (name,
+                                                            self.location))
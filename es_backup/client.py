@@ -0,0 +1,93 @@
+import threading
+import time
+from es_backup.config import option
+from es_backup.metrics import metrics
+
+
+class Client(object):
+    """HTTP client for elasticsearch. The session is set up on the first
+    request, so commands that never talk to elasticsearch do not import
+    requests. Options left as None are read from the [default] section."""
+
+    def __init__(self, pool_size=None, timeout=None, retries=None,
+                 backoff_factor=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.__session = None
+        self.__lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self.__session is None:
+            with self.__lock:
+                if self.__session is None:
+                    self.__session = self.__create_session()
+        return self.__session
+
+    def __create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        try:
+            from urllib3.util.retry import Retry
+        except ImportError:
+            from requests.packages.urllib3.util.retry import Retry
+
+        if self.pool_size is None:
+            self.pool_size = option('default', 'pool_size', 10, 'getint')
+        if self.timeout is None:
+            self.timeout = option('default', 'timeout', 30.0, 'getfloat')
+        if self.retries is None:
+            self.retries = option('default', 'retries', 3, 'getint')
+        if self.backoff_factor is None:
+            self.backoff_factor = option('default', 'retry_backoff', 0.5,
+                                         'getfloat')
+        # Requests that change the cluster are only retried when they could
+        # not be sent; a read timeout may mean elasticsearch is still at it.
+        if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+            methods = {'allowed_methods': frozenset(['GET', 'HEAD'])}
+        else:
+            methods = {'method_whitelist': frozenset(['GET', 'HEAD'])}
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=(502, 503, 504), **methods)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                'Content-Type': 'application/json'})
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        import requests
+        session = self.session
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.time()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException as error:
+            metrics.request(method, url, time.time() - started, error=error)
+            raise
+        retries = getattr(getattr(response.raw, 'retries', None), 'history',
+                          ())
+        metrics.request(method, url, time.time() - started,
+                        size=len(response.content), retries=len(retries),
+                        status=response.status_code)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+client = Client()
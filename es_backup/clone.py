@@ -0,0 +1,153 @@
+import errno
+import os
+import re
+import shutil
+import struct
+import tempfile
+from multiprocessing.pool import ThreadPool
+from es_backup.archive import walk_files
+from es_backup.catalog import CatalogError, OfflineRepository
+
+ROOT_INDEX = re.compile(r'^index-(\d+)$')
+MUTABLE = ('index.latest', 'incompatible-snapshots')
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+class CloneError(Exception):
+    pass
+
+
+def _device(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def _transfer(job):
+    """Hardlink or copy one file to a temporary name beside its target and
+    move it in place. Returns how it was transferred, or 'vanished' if the
+    source was deleted in the meantime, and its size."""
+    source, target, size, link = job
+    temp = '%s.clone-%s' % (target, os.getpid())
+    try:
+        if link:
+            try:
+                os.link(source, temp)
+                os.rename(temp, target)
+                return 'linked', size
+            except OSError as error:
+                if error.errno not in LINK_ERRORS:
+                    raise
+        shutil.copyfile(source, temp)
+        shutil.copystat(source, temp)
+        os.rename(temp, target)
+        return 'copied', size
+    except (IOError, OSError) as error:
+        if error.errno != errno.ENOENT or os.path.exists(source):
+            raise
+        if os.path.exists(temp):
+            os.unlink(temp)
+        return 'vanished', size
+
+
+def _generation(location):
+    try:
+        return OfflineRepository(None, location).generation
+    except (CatalogError, OSError):
+        return None
+
+
+def _write_latest(location, generation):
+    fd, temp = tempfile.mkstemp(dir=location, prefix='.index.latest-')
+    with os.fdopen(fd, 'wb') as latest:
+        latest.write(struct.pack('>q', generation))
+    os.chmod(temp, 0o644)
+    os.rename(temp, os.path.join(location, 'index.latest'))
+
+
+def clone_repo(source, target, workers=8, delete=False):
+    """Copy the fs repository at source to target as of its current
+    generation, using workers threads.
+
+    Blobs are hardlinked when both locations share a filesystem and copied
+    otherwise; blobs already at target with the same name and size are
+    skipped, as they never change once written. Shard data is transferred
+    before the snapshot metadata, then the repository index and finally
+    index.latest, so target never references a missing blob. With delete,
+    files of target the source no longer has are removed. Returns a report
+    of the files linked, copied, skipped and deleted and the bytes
+    copied.
+
+    Raises CloneError without touching target when it holds a newer
+    generation than source, i.e. it was written to since the last clone,
+    or when delete is given for a target that is neither empty nor a
+    repository. If source blobs are deleted while they are copied, target
+    is left at its previous generation and CloneError is raised too.
+    """
+    generation = OfflineRepository(None, source).generation
+    if os.path.isdir(target) and os.listdir(target):
+        current = _generation(target)
+        if current is None and delete:
+            raise CloneError('%s is not empty and holds no repository, '
+                             'refusing to delete its files' % target)
+        if current is not None and current > generation:
+            raise CloneError('%s is at generation %s, newer than generation '
+                             '%s of %s' % (target, current, generation,
+                                           source))
+    index = 'index-%s' % generation
+    link = _device(source) == _device(target)
+    report = {'generation': generation, 'linked': 0, 'copied': 0,
+              'skipped': 0, 'deleted': 0, 'vanished': 0, 'bytes': 0}
+
+    shards = []
+    metadata = []
+    root = []
+    wanted = set([index, 'index.latest'])
+    for relative, size in walk_files(source):
+        match = ROOT_INDEX.match(relative)
+        if relative == 'index.latest' or (match and relative != index):
+            continue
+        wanted.add(relative)
+        destination = os.path.join(target, relative)
+        if (relative not in MUTABLE and os.path.isfile(destination) and
+                os.path.getsize(destination) == size):
+            report['skipped'] += 1
+            continue
+        job = (os.path.join(source, relative), destination, size, link)
+        if relative == index:
+            root = [job]
+        elif relative.startswith('indices' + os.sep):
+            shards.append(job)
+        else:
+            metadata.append(job)
+
+    for directory in set(os.path.dirname(job[1])
+                         for job in shards + metadata + root):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        for jobs in (shards, metadata, root):
+            for method, size in pool.imap_unordered(_transfer, jobs):
+                report[method] += 1
+                if method == 'copied':
+                    report['bytes'] += size
+            if report['vanished']:
+                raise CloneError('%s files were deleted from %s while '
+                                 'cloning generation %s, run the clone '
+                                 'again' % (report['vanished'], source,
+                                            generation))
+        _write_latest(target, generation)
+        if delete:
+            stale = [os.path.join(target, relative)
+                     for relative, size in walk_files(target)
+                     if relative not in wanted]
+            pool.map(os.unlink, stale)
+            report['deleted'] = len(stale)
+    finally:
+        pool.close()
+        pool.join()
+    return report
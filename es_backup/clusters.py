@@ -0,0 +1,131 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from es_backup.config import config
+
+SECTION_PREFIX = 'cluster:'
+
+
+def cluster_names():
+    return [section[len(SECTION_PREFIX):] for section in config.sections()
+            if section.startswith(SECTION_PREFIX)]
+
+
+@contextmanager
+def use_sections(*sections):
+    """Resolve configuration options from sections, in order, before any
+    other section for the current thread."""
+    previous = getattr(config.local, 'overrides', ())
+    config.local.overrides = tuple(section for section in sections
+                                   if section)
+    try:
+        yield
+    finally:
+        config.local.overrides = previous
+
+
+def use_cluster(name):
+    """Resolve configuration options from [cluster:<name>] first for the
+    current thread. A name of None uses the plain configuration."""
+    return use_sections(SECTION_PREFIX + name if name else None)
+
+
+def current_cluster():
+    for section in getattr(config.local, 'overrides', ()):
+        if section.startswith(SECTION_PREFIX):
+            return section[len(SECTION_PREFIX):]
+    return None
+
+
+class ThreadOutput(object):
+    """Stand-in for sys.stdout sending the output of threads that have
+    started capturing to their own buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+
+    def release(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        (buffer or self.stream).write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+
+def _run(job):
+    cluster, label, func, args, semaphore, output = job
+    started = time.time()
+    result, failure = None, None
+    with semaphore:
+        output.capture()
+        try:
+            with use_cluster(cluster):
+                result = func(*args)
+        except BaseException as error:
+            failure = error
+        text = output.release()
+    return {'cluster': cluster, 'label': label, 'result': result,
+            'error': failure, 'output': text,
+            'duration': time.time() - started}
+
+
+def fan_out(tasks, workers=4, per_cluster=1, timeout=None):
+    """Run (cluster, label, func, args) tasks from a pool of workers threads
+    with at most per_cluster tasks of a cluster running at once.
+
+    Output printed by each task is captured and returned with its result,
+    error and duration, in task order. Tasks still running after timeout
+    seconds are reported with a timeout error; their threads cannot be
+    stopped and keep running until the process exits.
+    """
+    output = ThreadOutput(sys.stdout)
+    semaphores = dict((cluster, threading.BoundedSemaphore(per_cluster))
+                      for cluster, label, func, args in tasks)
+    pool = ThreadPool(max(1, min(workers, len(tasks))))
+    sys.stdout = output
+    try:
+        pending = [pool.apply_async(_run, ((cluster, label, func, args,
+                                            semaphores[cluster], output),))
+                   for cluster, label, func, args in tasks]
+        deadline = time.time() + timeout if timeout else None
+        results = []
+        for (cluster, label, func, args), job in zip(tasks, pending):
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            try:
+                results.append(job.get(remaining))
+            except Exception:
+                results.append({'cluster': cluster, 'label': label,
+                                'result': None, 'output': '',
+                                'error': RuntimeError(
+                                    'timed out after %ss, still running in '
+                                    'the background' % timeout),
+                                'duration': timeout})
+    finally:
+        sys.stdout = output.stream
+        pool.terminate()
+    return results
+
+
+def print_report(results):
+    for result in results:
+        print('== %s%s (%.2fs)%s ==' % (
+              result['cluster'] or 'default',
+              ' %s' % result['label'] if result['label'] else '',
+              result['duration'],
+              ' FAILED: %s' % result['error'] if result['error'] else ''))
+        sys.stdout.write(result['output'])
@@ -1,6 +1,7 @@
 import ConfigParser
 import os
 import sys
+import threading
 
 if os.environ.get('CONFIG') and os.path.exists(os.environ.get('CONFIG')):
     config_path = os.environ['CONFIG']
@@ -8,5 +9,84 @@ else:
     cwd = os.path.abspath(os.path.dirname(sys.argv[0]))
     config_path = '%s/etc/es_backup.conf' % cwd
 
-config = ConfigParser.ConfigParser()
-config.read(config_path)
+
+class ClusterConfigParser(ConfigParser.ConfigParser):
+    """ConfigParser where options set in the override sections selected for
+    the current thread, such as [cluster:<name>], take precedence over those
+    of any other section. An override of option of [section] is written
+    section.option in the override section; options of [default] may also
+    be written without the section. The config file is only read when the
+    first option or section is looked up."""
+
+    def __init__(self, path=None):
+        ConfigParser.ConfigParser.__init__(self)
+        self.local = threading.local()
+        self.path = path
+        self.__loaded = path is None
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        if self.__loaded:
+            return
+        with self.__lock:
+            if not self.__loaded:
+                self.read(self.path)
+                self.__loaded = True
+
+    def sections(self):
+        self.__load()
+        return ConfigParser.ConfigParser.sections(self)
+
+    def has_section(self, section):
+        self.__load()
+        return ConfigParser.ConfigParser.has_section(self, section)
+
+    def options(self, section):
+        self.__load()
+        return ConfigParser.ConfigParser.options(self, section)
+
+    def items(self, section, *args, **kwargs):
+        self.__load()
+        return ConfigParser.ConfigParser.items(self, section, *args, **kwargs)
+
+    def __resolve(self, section, option):
+        names = ['%s.%s' % (section, option)]
+        if section == 'default':
+            names.append(option)
+        for override in getattr(self.local, 'overrides', ()):
+            if override == section:
+                continue
+            for name in names:
+                if ConfigParser.ConfigParser.has_option(self, override, name):
+                    return override, name
+        return section, option
+
+    def has_option(self, section, option):
+        self.__load()
+        return ConfigParser.ConfigParser.has_option(
+            self, *self.__resolve(section, option))
+
+    def inherit(self):
+        """Return a thread initializer applying the override sections of
+        the calling thread to the thread it runs in."""
+        overrides = getattr(self.local, 'overrides', ())
+
+        def apply_overrides():
+            self.local.overrides = overrides
+        return apply_overrides
+
+    def get(self, section, option, *args, **kwargs):
+        self.__load()
+        return ConfigParser.ConfigParser.get(
+            self, *self.__resolve(section, option) + args, **kwargs)
+
+
+config = ClusterConfigParser(config_path)
+
+
+def option(section, name, default=None, getter='get'):
+    """Return option name of section through getter, or default when the
+    section or option is not in the config."""
+    if config.has_option(section, name):
+        return getattr(config, getter)(section, name)
+    return default
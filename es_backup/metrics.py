@@ -0,0 +1,201 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from es_backup.clusters import current_cluster
+from es_backup.config import option
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+def endpoint(url):
+    """Reduce a request url to its endpoint, replacing repository, snapshot
+    and index names with placeholders."""
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    segments = [segment for segment in path.split('/')[1:] if segment]
+    names = []
+    for i, segment in enumerate(segments):
+        if (segment.startswith('_') or '_nodes' in segments[:i] or
+                segments[i - 1:i] == ['_cat']):
+            names.append(segment)
+        elif '_snapshot' in segments[:i]:
+            names.append('{snapshot}' if '{repo}' in names else '{repo}')
+        else:
+            names.append('{index}')
+    return '/' + '/'.join(names)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics(object):
+    """Collects timings of elasticsearch requests and snapshot outcomes.
+
+    Listeners added with add_listener are called with every event as it is
+    recorded, for tracing; export() writes the aggregates in the format set
+    in the [metrics] section. Only the latest snapshot of each repository is
+    kept, so a long running daemon does not collect one record per snapshot.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.snapshots = {}
+        self.events = []
+        self.phases = []
+        self.listeners = []
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def __emit(self, event):
+        self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+
+    def request(self, method, url, duration, size=0, retries=0, status=None,
+                error=None):
+        key = (current_cluster() or 'default', method, endpoint(url))
+        failed = error is not None or (status is not None and status >= 400)
+        with self.__lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = {'latency': Histogram(),
+                                              'bytes': 0, 'retries': 0,
+                                              'errors': 0}
+            stats['latency'].observe(duration)
+            stats['bytes'] += size
+            stats['retries'] += retries
+            stats['errors'] += int(failed)
+            phase = getattr(self.__local, 'phase', None)
+            if phase is not None:
+                phase['requests'] += 1
+                phase['request_time'] += duration
+            self.__emit({'type': 'request', 'time': time.time(),
+                         'cluster': key[0], 'method': method,
+                         'endpoint': key[2], 'duration': duration,
+                         'bytes': size, 'retries': retries,
+                         'status': status,
+                         'error': str(error) if error else None})
+
+    def snapshot(self, repository, name, state, duration=None, size=None,
+                 failed_shards=None):
+        key = (current_cluster() or 'default', repository)
+        with self.__lock:
+            record = self.snapshots.get(key)
+            if record is None or record['snapshot'] != name:
+                record = self.snapshots[key] = {'snapshot': name}
+            for field, value in (('state', state), ('duration', duration),
+                                 ('bytes', size),
+                                 ('failed_shards', failed_shards)):
+                if value is not None:
+                    record[field] = value
+            record['time'] = time.time()
+            self.__emit(dict(record, type='snapshot', cluster=key[0],
+                             repository=repository))
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of a command along with the elasticsearch requests
+        made from the current thread while it runs."""
+        if current_cluster():
+            name = '%s/%s' % (current_cluster(), name)
+        phase = {'name': name, 'requests': 0, 'request_time': 0.0}
+        previous = getattr(self.__local, 'phase', None)
+        self.__local.phase = phase
+        started = time.time()
+        try:
+            yield phase
+        finally:
+            phase['duration'] = time.time() - started
+            self.__local.phase = previous
+            with self.__lock:
+                self.phases.append(phase)
+
+    def print_profile(self):
+        print('%-30s %10s %10s %12s' % ('Phase', 'Seconds', 'Requests',
+                                        'HTTP seconds'))
+        for phase in self.phases:
+            print('%-30s %10.3f %10d %12.3f' % (
+                  phase['name'], phase['duration'], phase['requests'],
+                  phase['request_time']))
+
+    def prometheus(self):
+        lines = []
+        metric = 'es_backup_request_duration_seconds'
+        lines.append('# TYPE %s histogram' % metric)
+        for (cluster, method, path), stats in sorted(self.requests.items()):
+            labels = 'cluster="%s",method="%s",endpoint="%s"' % (
+                cluster, method, path)
+            histogram = stats['latency']
+            for bound, count in zip(BUCKETS, histogram.counts):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels,
+                                                           bound, count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, labels,
+                                                         histogram.count))
+            lines.append('%s_sum{%s} %f' % (metric, labels, histogram.sum))
+            lines.append('%s_count{%s} %d' % (metric, labels,
+                                              histogram.count))
+        for name, field in (('response_bytes', 'bytes'),
+                            ('request_retries', 'retries'),
+                            ('request_errors', 'errors')):
+            metric = 'es_backup_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+            for (cluster, method, path), stats in sorted(
+                    self.requests.items()):
+                lines.append('%s{cluster="%s",method="%s",endpoint="%s"} %d'
+                             % (metric, cluster, method, path,
+                                stats[field]))
+        for name, field in (('duration_seconds', 'duration'),
+                            ('bytes', 'bytes'),
+                            ('failed_shards', 'failed_shards'),
+                            ('timestamp_seconds', 'time')):
+            metric = 'es_backup_snapshot_%s' % name
+            lines.append('# TYPE %s gauge' % metric)
+            for (cluster, repository), record in sorted(
+                    self.snapshots.items()):
+                if field in record:
+                    lines.append('%s{cluster="%s",repository="%s",'
+                                 'state="%s"} %s' % (
+                                     metric, cluster, repository,
+                                     record.get('state'), record[field]))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, output_format=None, path=None):
+        if output_format is None:
+            output_format = option('metrics', 'format', 'none')
+        if path is None:
+            path = option('metrics', 'path',
+                          '/var/lib/node_exporter/textfile_collector/'
+                          'es_backup.prom')
+        if output_format == 'prometheus':
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as metrics_file:
+                metrics_file.write(self.prometheus())
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, path)
+        elif output_format == 'jsonl':
+            with open(path, 'a') as metrics_file:
+                for event in self.events:
+                    metrics_file.write('%s\n' % json.dumps(event,
+                                                           sort_keys=True))
+        self.events = []
+
+
+metrics = Metrics()
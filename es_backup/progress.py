@@ -0,0 +1,164 @@
+import json
+import time
+from datetime import datetime
+from es_backup.metrics import metrics
+
+TERMINAL_STATES = ('SUCCESS', 'FAILED', 'PARTIAL', 'ABORTED', 'MISSING')
+MB = 1024.0 * 1024.0
+
+
+def stats_progress(stats):
+    """Return (files_done, files_total, bytes_done, bytes_total) for a
+    snapshot status stats block from either the pre-7.x or 7.x layout."""
+    if 'incremental' in stats:
+        return (stats['processed'].get('file_count', 0),
+                stats['incremental'].get('file_count', 0),
+                stats['processed'].get('size_in_bytes', 0),
+                stats['incremental'].get('size_in_bytes', 0))
+    return (stats.get('processed_files', 0), stats.get('number_of_files', 0),
+            stats.get('processed_size_in_bytes', 0),
+            stats.get('total_size_in_bytes', 0))
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024.0:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fTB' % size
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60,
+                               seconds % 60)
+
+
+def _percent(done, total):
+    if not total:
+        return 100.0
+    return 100.0 * done / total
+
+
+def report_status(status, rate, eta):
+    files_done, files_total, bytes_done, bytes_total = stats_progress(
+        status.get('stats', {}))
+    shards = status.get('shards_stats', {})
+    print('%s %s/%s: %s/%s (%.1f%%) files %s/%s shards %s/%s done '
+          '%.2f MB/s ETA %s' % (status.get('state'), status.get('repository'),
+                                status.get('snapshot'),
+                                format_bytes(bytes_done),
+                                format_bytes(bytes_total),
+                                _percent(bytes_done, bytes_total),
+                                files_done, files_total, shards.get('done', 0),
+                                shards.get('total', 0), rate / MB,
+                                format_seconds(eta)))
+    for index, index_status in sorted(status.get('indices', {}).items()):
+        files_done, files_total, bytes_done, bytes_total = stats_progress(
+            index_status.get('stats', {}))
+        if bytes_total and bytes_done >= bytes_total:
+            continue
+        print('  %s: %s/%s (%.1f%%) files %s/%s' % (
+              index, format_bytes(bytes_done), format_bytes(bytes_total),
+              _percent(bytes_done, bytes_total), files_done, files_total))
+        for shard, shard_status in sorted(index_status.get('shards',
+                                                           {}).items()):
+            if shard_status.get('stage') == 'DONE':
+                continue
+            files_done, files_total, bytes_done, bytes_total = \
+                stats_progress(shard_status.get('stats', {}))
+            print('    shard %s [%s] on %s: %s/%s files %s/%s' % (
+                  shard, shard_status.get('stage'), shard_status.get('node'),
+                  format_bytes(bytes_done), format_bytes(bytes_total),
+                  files_done, files_total))
+
+
+def node_throughput(status):
+    """Aggregate bytes and shard time per node so slow nodes stand out."""
+    nodes = {}
+    for index_status in status.get('indices', {}).values():
+        for shard_status in index_status.get('shards', {}).values():
+            stats = shard_status.get('stats', {})
+            node = nodes.setdefault(shard_status.get('node', 'unknown'),
+                                    {'bytes': 0, 'seconds': 0.0, 'shards': 0})
+            node['bytes'] += stats_progress(stats)[2]
+            node['seconds'] += stats.get('time_in_millis', 0) / 1000.0
+            node['shards'] += 1
+    for node in nodes.values():
+        if node['seconds']:
+            node['mb_per_sec'] = round(node['bytes'] / MB / node['seconds'],
+                                       2)
+        else:
+            node['mb_per_sec'] = None
+    return nodes
+
+
+def summarize(snapshot, status, duration):
+    files_done, files_total, bytes_done, bytes_total = stats_progress(
+        status.get('stats', {}))
+    shards = status.get('shards_stats', {})
+    if duration:
+        throughput = round(bytes_done / MB / duration, 2)
+    else:
+        throughput = None
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'repository': snapshot.repo.name,
+        'snapshot': snapshot.name,
+        'state': getattr(snapshot, 'state', status.get('state')),
+        'duration': round(duration, 3),
+        'bytes': bytes_done,
+        'files': files_done,
+        'mb_per_sec': throughput,
+        'shards_total': shards.get('total', 0),
+        'shards_failed': shards.get('failed', 0),
+        'failures': getattr(snapshot, 'failures', None),
+        'nodes': node_throughput(status)
+    }
+
+
+def write_summary(summary, path):
+    with open(path, 'a') as summary_file:
+        summary_file.write('%s\n' % json.dumps(summary, sort_keys=True))
+
+
+def wait_for_snapshot(snapshot, min_interval=1.0, max_interval=30.0,
+                      quiet=False):
+    """Poll the snapshot status until it reaches a terminal state.
+
+    The poll interval doubles while no bytes are moving and drops back to
+    min_interval when progress resumes, capped by max_interval and by the
+    current ETA. Returns a summary record of the finished snapshot.
+    """
+    started = time.time()
+    interval = min_interval
+    last_bytes, last_time = 0, started
+    rate = 0.0
+    while True:
+        status = snapshot.status()
+        now = time.time()
+        bytes_done, bytes_total = stats_progress(status.get('stats', {}))[2:]
+        if now > last_time and bytes_done > last_bytes:
+            rate = (bytes_done - last_bytes) / (now - last_time)
+            interval = min_interval
+        else:
+            interval = min(interval * 2, max_interval)
+        last_bytes, last_time = bytes_done, now
+        eta = None
+        if rate:
+            eta = (bytes_total - bytes_done) / rate
+            interval = max(min_interval, min(interval, eta))
+        if status.get('state') in TERMINAL_STATES:
+            break
+        if not quiet:
+            report_status(status, rate, eta)
+        time.sleep(interval)
+    snapshot.update_status()
+    duration = getattr(snapshot, 'duration', None) or (time.time() - started)
+    summary = summarize(snapshot, status, duration)
+    metrics.snapshot(snapshot.repo.name, snapshot.name, summary['state'],
+                     duration=summary['duration'], size=summary['bytes'],
+                     failed_shards=summary['shards_failed'])
+    return summary
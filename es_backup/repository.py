@@ -1,45 +1,144 @@
 import json
 import re
-import requests
-import shutil
+from multiprocessing.pool import ThreadPool
+from es_backup.cache import cache, snapshot_keys
+from es_backup.client import client
 from es_backup.config import config
+from es_backup.retention import rmtree
 from es_backup.snapshot import Snapshot
 
 
+def _repo_uuid(data):
+    uuid = data.get('uuid')
+    return uuid if uuid and uuid != '_na_' else None
+
+
 class Repository(object):
+    _uuid = False
+
     def __init__(self, name):
         base_url = config.get('default', 'base_url')
         self.name = name
         self.url = '%s/_snapshot/%s' % (base_url, self.name)
 
+    def __load_uuid(self, fetch):
+        if self._uuid is False:
+            repos = cache.get('repos')
+            if repos is not None and self.name in repos:
+                self._uuid = _repo_uuid(repos[self.name])
+            elif fetch:
+                response = client.get(self.url)
+                data = {}
+                if response.status_code < 300:
+                    data = response.json().get(self.name, {})
+                self._uuid = _repo_uuid(data)
+        return self._uuid or None
+
+    @property
+    def uuid(self):
+        """UUID elasticsearch (7.12+) reports for the repository, or None.
+        Snapshot metadata is cached under it, so a repository registered
+        again under the same name never sees the entries of another."""
+        return self.__load_uuid(True)
+
+    def snapshot_key(self, name, fetch=False):
+        """Cache key of the metadata of snapshot name, or None when the
+        UUID of the repository is unknown. The UUID is only requested from
+        elasticsearch with fetch, which invalidations use."""
+        uuid = self.__load_uuid(fetch)
+        if uuid is None:
+            return None
+        return 'snapshot/%s/%s' % (uuid, name)
+
     def __exists(self):
-        response = requests.get('%s' % self.url)
+        response = client.get('%s' % self.url)
         if response.status_code < 300:
             return True
         return False
 
-    def list_snapshots(self):
-        response = requests.get('%s/_all' % self.url)
-        data = response.json()
-        snapshot_list = data['snapshots']
-        snapshots = []
+    def list_snapshots(self, verbose=True):
+        """Yield the snapshots of the repository. Without verbose only the
+        name and state of each snapshot are fetched, where the cluster
+        supports it (elasticsearch 5.5+)."""
+        verbose = verbose or cluster_version() < (5, 5)
+        key = '%s/%s' % ('snapshots' if verbose else 'snapshot-names',
+                         self.name)
+        snapshot_list = cache.get(key)
+        if snapshot_list is None and not verbose:
+            snapshot_list = cache.get('snapshots/%s' % self.name)
+        if snapshot_list is None:
+            response = client.get('%s/_all' % self.url,
+                                  params=None if verbose else
+                                  {'verbose': 'false',
+                                   'filter_path': 'snapshots.snapshot,'
+                                                  'snapshots.state'})
+            response.raise_for_status()
+            snapshot_list = response.json().get('snapshots', [])
+            cache.set(key, snapshot_list)
         for snapshot in snapshot_list:
-            snapshots.append(Snapshot(snapshot['snapshot'], self))
-        return snapshots
+            yield Snapshot(snapshot['snapshot'], self, data=snapshot)
 
-    def delete(self):
-        response = requests.delete(self.url)
+    def get_snapshot(self, name):
+        """Return snapshot name of the repository, or None if it does not
+        exist. Unlike Snapshot(name, repo), a missing snapshot is not
+        created."""
+        response = client.get('%s/%s' % (self.url, name))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return Snapshot(name, self, data=response.json()['snapshots'][0])
+
+    def delete_snapshots(self, snapshots, batch_size=100):
+        names = [snapshot.name for snapshot in snapshots]
+        if cluster_version() < (7, 8):
+            batch_size = 1
+        for i in range(0, len(names), batch_size):
+            batch = ','.join(names[i:i + batch_size])
+            response = client.delete('%s/%s' % (self.url, batch),
+                                     timeout=None)
+            cache.invalidate(*snapshot_keys(self, *names[i:i + batch_size]))
+            if response.status_code >= 400:
+                response.raise_for_status()
+
+    def get_settings(self):
+        response = client.get(self.url)
+        response.raise_for_status()
+        return response.json()[self.name]
+
+    def update_settings(self, **settings):
+        repo_data = self.get_settings()
+        repo_data['settings'].update(settings)
+        response = client.put(self.url, data=json.dumps(repo_data))
+        cache.invalidate('repos')
+        response.raise_for_status()
+        return repo_data
+
+    def register(self, repo_data):
+        response = client.put(self.url, data=json.dumps(repo_data))
+        cache.invalidate('repos')
+        response.raise_for_status()
+
+    def unregister(self):
+        response = client.delete(self.url)
+        cache.invalidate('repos', *snapshot_keys(self),
+                         prefix='snapshot/%s/' % self.uuid if self.uuid
+                         else None)
         if response.status_code >= 400:
             response.raise_for_status()
 
+    def delete(self):
+        self.unregister()
+
 
 class FileRepository(Repository):
     def __init__(self, name, location=None, compress=True, chunk_size=None,
-                 restore_rate='20mb', snapshot_rate='20mb'):
+                 restore_rate='20mb', snapshot_rate='20mb', data=None):
         base_url = config.get('default', 'base_url')
         self.name = name
         self.url = '%s/_snapshot/%s' % (base_url, name)
-        if self.__get_repo() is False:
+        if data is not None:
+            self.__load_repo(data)
+        elif self.__get_repo() is False:
             self.type = 'fs'
             self.location = location
             self.compress = compress
@@ -52,21 +151,32 @@ class FileRepository(Repository):
         return 'repo %s - location: %s' % (self.name, self.location)
 
     def __get_repo(self):
-        response = requests.get('%s' % self.url)
+        repos = cache.get('repos')
+        if repos is not None and self.name in repos:
+            self.__load_repo(repos[self.name])
+            return True
+        response = client.get('%s' % self.url)
         if response.status_code < 300:
             data = response.json()
-            self.type = data[self.name]['type']
-            self.location = data[self.name]['settings'].get('location')
-            self.compress = data[self.name]['settings'].get('compress')
-            self.chunk_size = data[self.name]['settings'].get('chunk_size',
-                                                              None)
-            self.restore_rate = (data[self.name]['settings'].get(
-                                 'max_restore_bytes_per_sec', '20mb'))
-            self.snapshot_rate = (data[self.name]['settings'].get(
-                                  'max_snapshot_bytes_per_sec', '20mb'))
+            self.__load_repo(data[self.name])
             return True
         return False
 
+    def __load_repo(self, data):
+        settings = data.get('settings', {})
+        self.type = data['type']
+        self._uuid = _repo_uuid(data)
+        self.location = settings.get('location')
+        self.compress = settings.get('compress')
+        self.chunk_size = settings.get('chunk_size', None)
+        self.restore_rate = settings.get('max_restore_bytes_per_sec', '20mb')
+        self.snapshot_rate = settings.get('max_snapshot_bytes_per_sec', '20mb')
+
+    def update_settings(self, **settings):
+        repo_data = super(FileRepository, self).update_settings(**settings)
+        self.__load_repo(repo_data)
+        return repo_data
+
     def __create_repo(self):
         repo_data = {
             'type': 'fs',
@@ -78,14 +188,18 @@ class FileRepository(Repository):
                 'max_snapshot_bytes_per_sec': self.snapshot_rate
             }
         }
-        response = requests.put(self.url, data=json.dumps(repo_data))
+        response = client.put(self.url, data=json.dumps(repo_data))
+        cache.invalidate('repos')
         response.raise_for_status()
 
-    def delete(self):
-        response = requests.delete(self.url)
-        if response.status_code >= 400:
-            response.raise_for_status()
-        shutil.rmtree(self.location)
+    def delete(self, workers=16):
+        self.unregister()
+        pool = ThreadPool(workers)
+        try:
+            rmtree(self.location, pool)
+        finally:
+            pool.close()
+            pool.join()
 
 
 class S3_Repository(Repository):
@@ -103,16 +217,38 @@ class Azure_Repository(Repository):
         pass
 
 
+_versions = {}
+
+
+def cluster_version():
+    """Return the version of the current cluster as a tuple of ints. It is
+    kept in the metadata cache, so most commands do not have to ask."""
+    base_url = config.get('default', 'base_url')
+    if base_url not in _versions:
+        version = cache.get('version')
+        if version is None:
+            response = client.get(base_url)
+            response.raise_for_status()
+            number = response.json()['version']['number']
+            version = [int(part) for part in re.findall(r'\d+', number)[:3]]
+            cache.set('version', version)
+        _versions[base_url] = tuple(version)
+    return _versions[base_url]
+
+
 def list_repos(match=None):
-    response = requests.get('%s/_snapshot/_all' % config.get('default',
-                            'base_url'))
-    data = response.json()
+    data = cache.get('repos')
+    if data is None:
+        response = client.get('%s/_snapshot/_all' % config.get('default',
+                              'base_url'))
+        data = response.json()
+        cache.set('repos', data)
     if match:
         data = {repo: data[repo] for repo in data if re.match(match, repo)}
     repos = []
     for name in data:
         if data[name]['type'] == 'fs':
-            repos.append(FileRepository(name))
+            repos.append(FileRepository(name, data=data[name]))
         if data[name]['type'] == 's3':
             repos.append(S3_Repository(name))
         if data[name]['type'] == 'hdfs':
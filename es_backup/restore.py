@@ -0,0 +1,166 @@
+import fnmatch
+import re
+import time
+from es_backup.client import client
+from es_backup.config import config
+from es_backup.progress import MB, format_bytes, format_seconds
+from es_backup.throttle import start_adaptive_rate
+
+
+class RestoreError(Exception):
+    pass
+
+
+def select_indices(available, patterns=None, priority=None):
+    """Return the indices of available matching any of patterns (all when
+    empty), ordered by the first priority pattern they match and then by
+    name."""
+    if patterns:
+        selected = [index for index in available
+                    if any(fnmatch.fnmatch(index, pattern)
+                           for pattern in patterns)]
+    else:
+        selected = list(available)
+    priority = priority or []
+
+    def rank(index):
+        for i, pattern in enumerate(priority):
+            if fnmatch.fnmatch(index, pattern):
+                return (i, index)
+        return (len(priority), index)
+
+    return sorted(selected, key=rank)
+
+
+def restored_name(index, rename_pattern=None, rename_replacement=None):
+    """Apply an elasticsearch rename pattern and $n style replacement."""
+    if rename_pattern is None:
+        return index
+    replacement = re.sub(r'\$(\d+)', r'\\\1', rename_replacement or '')
+    return re.sub(rename_pattern, replacement, index)
+
+
+def recovery_progress(indices):
+    """Return a dict of index to (bytes_done, bytes_total, done) from the
+    recovery of its primary shards."""
+    base_url = config.get('default', 'base_url')
+    response = client.get('%s/%s/_recovery' % (base_url, ','.join(indices)),
+                          params={'ignore_unavailable': 'true'})
+    response.raise_for_status()
+    progress = {}
+    for index, recovery in response.json().items():
+        primaries = [shard for shard in recovery.get('shards', [])
+                     if shard.get('primary')]
+        done = sum(shard['index']['size'].get('recovered_in_bytes', 0)
+                   for shard in primaries)
+        total = sum(shard['index']['size'].get('total_in_bytes', 0)
+                    for shard in primaries)
+        finished = bool(primaries) and all(shard.get('stage') == 'DONE'
+                                           for shard in primaries)
+        progress[index] = (done, total, finished)
+    return progress
+
+
+def restore_snapshot(snapshot, indices, batch_size=5, concurrency=1,
+                     rename_pattern=None, rename_replacement=None,
+                     restore_rate=None, ignore_unavailable=False,
+                     include_global_state=False, partial=False,
+                     poll_interval=2.0, adaptive=False,
+                     missing_timeout=60.0):
+    """Restore indices of snapshot in order, batch_size indices per restore
+    request with up to concurrency requests in flight, and track their
+    recovery until every restored index is usable.
+
+    restore_rate temporarily overrides max_restore_bytes_per_sec of the
+    repository for the duration of the restore; adaptive adjusts it to the
+    cluster load while the restore runs. Raises RestoreError when a
+    restored index has no recovery missing_timeout seconds after its
+    restore was accepted. Returns a summary with the time each index
+    became usable.
+    """
+    batches = [indices[i:i + batch_size]
+               for i in range(0, len(indices), batch_size)]
+    original_rate = None
+    if restore_rate:
+        settings = snapshot.repo.get_settings()['settings']
+        original_rate = settings.get('max_restore_bytes_per_sec', '20mb')
+        snapshot.repo.update_settings(max_restore_bytes_per_sec=restore_rate)
+        print('Restore rate of repository %s set to %s' % (
+              snapshot.repo.name, restore_rate))
+
+    started = time.time()
+    usable = {}
+    last = {}
+    requested = {}
+    in_flight = []
+    first_global = include_global_state
+    controller = None
+    try:
+        if adaptive:
+            controller = start_adaptive_rate(snapshot.repo,
+                                             'max_restore_bytes_per_sec')
+        while batches or in_flight:
+            while batches and len(in_flight) < concurrency:
+                batch = batches.pop(0)
+                snapshot.restore(indices=','.join(batch),
+                                 rename_pattern=rename_pattern,
+                                 rename_replacement=rename_replacement,
+                                 ignore_unavailable=ignore_unavailable,
+                                 include_global_state=first_global,
+                                 partial=partial)
+                first_global = False
+                targets = [restored_name(index, rename_pattern,
+                                         rename_replacement)
+                           for index in batch]
+                print('Restoring %s' % ', '.join(targets))
+                in_flight.append(targets)
+                requested.update((index, time.time()) for index in targets)
+
+            time.sleep(poll_interval)
+            now = time.time()
+            progress = recovery_progress([index for batch in in_flight
+                                          for index in batch])
+            for batch in in_flight:
+                for index in batch:
+                    if (index not in progress and index not in usable and
+                            now - requested[index] > missing_timeout):
+                        raise RestoreError(
+                            'Index %s did not start recovering within %s of '
+                            'its restore being accepted' % (
+                                index, format_seconds(missing_timeout)))
+            for index in sorted(progress):
+                done, total, finished = progress[index]
+                if index in usable:
+                    continue
+                if finished:
+                    usable[index] = now - started
+                    print('Index %s usable after %s (%s)' % (
+                          index, format_seconds(usable[index]),
+                          format_bytes(total)))
+                    continue
+                last_done, last_time = last.get(index, (0, started))
+                rate = (done - last_done) / max(now - last_time, 0.001)
+                last[index] = (done, now)
+                eta = (total - done) / rate if rate > 0 else None
+                print('  %s: %s/%s %.2f MB/s ETA %s' % (
+                      index, format_bytes(done), format_bytes(total),
+                      rate / MB, format_seconds(eta)))
+            in_flight = [batch for batch in in_flight
+                         if not all(index in usable for index in batch)]
+    finally:
+        if controller is not None:
+            controller.stop()
+        if original_rate is not None:
+            snapshot.repo.update_settings(
+                max_restore_bytes_per_sec=original_rate)
+            print('Restore rate of repository %s reset to %s' % (
+                  snapshot.repo.name, original_rate))
+
+    duration = time.time() - started
+    return {
+        'repository': snapshot.repo.name,
+        'snapshot': snapshot.name,
+        'duration': round(duration, 3),
+        'first_usable': round(min(usable.values()), 3) if usable else None,
+        'indices': usable
+    }
@@ -0,0 +1,184 @@
+import os
+import re
+import time
+from multiprocessing.pool import ThreadPool
+from es_backup.config import config
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+def _clear_dir(path):
+    """Unlink every non-directory entry of path and return its subdirectories
+    along with the number of files removed."""
+    subdirs = []
+    files = 0
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        else:
+            os.unlink(entry.path)
+            files += 1
+    return subdirs, files
+
+
+def rmtree(path, pool):
+    """Remove a directory tree using the threads of pool.
+
+    The tree is walked breadth first with every directory of a level cleared
+    of files in parallel, then the emptied directories are removed deepest
+    level first. Returns the number of files removed.
+    """
+    levels = [[path]]
+    files = 0
+    while levels[-1]:
+        subdirs = []
+        for found, removed in pool.imap_unordered(_clear_dir, levels[-1]):
+            subdirs.extend(found)
+            files += removed
+        levels.append(subdirs)
+    for level in reversed(levels):
+        pool.map(os.rmdir, level)
+    return files
+
+
+def _unregister(repo):
+    started = time.time()
+    try:
+        repo.unregister()
+        return repo, time.time() - started, None
+    except Exception as error:
+        return repo, time.time() - started, error
+
+
+def remove_repos(repos, workers=4, rmtree_workers=16, dry_run=False):
+    """Unregister repos concurrently, then delete the directory tree of each
+    file repository with a shared pool of rmtree_workers threads.
+
+    Returns a report entry per repository with the time spent unregistering
+    and deleting, the number of files removed and any error raised.
+    """
+    report = []
+    if dry_run or not repos:
+        for repo in repos:
+            report.append({'name': repo.name,
+                           'location': getattr(repo, 'location', None),
+                           'unregister': 0.0, 'delete': 0.0, 'files': 0,
+                           'error': None})
+        return report
+
+    pool = ThreadPool(min(workers, len(repos)), initializer=config.inherit())
+    try:
+        unregistered = pool.map(_unregister, repos)
+    finally:
+        pool.close()
+        pool.join()
+
+    pool = ThreadPool(rmtree_workers)
+    try:
+        for repo, unregister_time, error in unregistered:
+            entry = {'name': repo.name,
+                     'location': getattr(repo, 'location', None),
+                     'unregister': unregister_time, 'delete': 0.0, 'files': 0,
+                     'error': error}
+            report.append(entry)
+            if error is not None or not entry['location']:
+                continue
+            started = time.time()
+            try:
+                entry['files'] = rmtree(entry['location'], pool)
+            except Exception as error:
+                entry['error'] = error
+            entry['delete'] = time.time() - started
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+KEEP_STATES = ('SUCCESS', 'PARTIAL')
+RUNNING_STATES = ('IN_PROGRESS', 'STARTED', 'INIT')
+PRUNE_BUCKETS = (('hourly', '%Y-%m-%d %H'), ('daily', '%Y-%m-%d'),
+                 ('weekly', None))
+GROUP_NAME = re.compile(r'^(.+)_([1-9]\d*)$')
+
+
+def _bucket(start_time, fmt):
+    if fmt is None:
+        return start_time.isocalendar()[:2]
+    return start_time.strftime(fmt)
+
+
+def backup_sets(snapshots):
+    """Group the snapshots of grouped backups, named <name>_1 to <name>_<n>,
+    into one list per backup. Any other snapshot, including those of a
+    <name> whose numbers do not run from 1 to n, is a set of its own."""
+    sets = []
+    groups = {}
+    for snapshot in snapshots:
+        match = GROUP_NAME.match(snapshot.name)
+        if match:
+            groups.setdefault(match.group(1), []).append(
+                (int(match.group(2)), snapshot))
+        else:
+            sets.append([snapshot])
+    for members in groups.values():
+        members.sort(key=lambda member: member[0])
+        if [number for number, snapshot in members] == \
+                list(range(1, len(members) + 1)):
+            sets.append([snapshot for number, snapshot in members])
+        else:
+            sets.extend([snapshot] for number, snapshot in members)
+    return sets
+
+
+def select_snapshots(snapshots, keep_last=0, keep_hourly=0, keep_daily=0,
+                     keep_weekly=0):
+    """Split snapshots into those kept and those to delete in one pass.
+
+    The snapshots of a grouped backup (<name>_<n>) are one backup set,
+    dated by its first snapshot, and are kept or deleted together. The
+    newest keep_last completed sets are kept, as is the newest completed
+    set of each of the latest keep_hourly hours, keep_daily days and
+    keep_weekly ISO weeks. Snapshots this cluster can not restore from
+    (FAILED or INCOMPATIBLE) are always deleted and do not count towards
+    keep_last; sets with a snapshot still in progress are neither kept nor
+    deleted. Returns (keep, delete), both newest first.
+    """
+    if not (keep_last or keep_hourly or keep_daily or keep_weekly):
+        raise ValueError('At least one keep rule must be set')
+    limits = {'hourly': keep_hourly, 'daily': keep_daily,
+              'weekly': keep_weekly}
+    seen = dict((rule, set()) for rule, fmt in PRUNE_BUCKETS)
+    keep = []
+    delete = []
+    last = 0
+    for members in sorted(backup_sets(snapshots),
+                          key=lambda members: min(snap.start_time
+                                                  for snap in members),
+                          reverse=True):
+        if any(snap.state in RUNNING_STATES for snap in members):
+            continue
+        completed = [snap for snap in members if snap.state in KEEP_STATES]
+        delete.extend(snap for snap in members
+                      if snap.state not in KEEP_STATES)
+        if not completed:
+            continue
+        start_time = min(snap.start_time for snap in members)
+        kept = False
+        if last < keep_last:
+            last += 1
+            kept = True
+        for rule, fmt in PRUNE_BUCKETS:
+            bucket = _bucket(start_time, fmt)
+            if (bucket not in seen[rule] and
+                    len(seen[rule]) < limits[rule]):
+                seen[rule].add(bucket)
+                kept = True
+        if kept:
+            keep.extend(completed)
+        else:
+            delete.extend(completed)
+    return keep, delete
@@ -0,0 +1,182 @@
+import errno
+import fcntl
+import os
+import re
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31),
+          ('month', 1, 12), ('weekday', 0, 7))
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        match = re.match(r'^(\*|\d+)(?:-(\d+))?(?:/(\d+))?$', part)
+        if not match:
+            raise ScheduleError('Invalid cron field %s' % field)
+        start, end, step = match.groups()
+        if start == '*':
+            start, end = low, high
+        else:
+            start = int(start)
+            end = int(end) if end is not None else (high if step else start)
+        step = int(step) if step else 1
+        if start < low or end > high or start > end or step < 1:
+            raise ScheduleError('Cron field %s out of range %s-%s' %
+                                (field, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    """Standard five field cron expression: minute hour day-of-month month
+    day-of-week, each accepting *, lists, ranges and steps."""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ScheduleError('Cron expression %r needs 5 fields' %
+                                expression)
+        self.expression = expression
+        parsed = [_parse_field(field, low, high)
+                  for field, (name, low, high) in zip(fields, FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        if 7 in weekdays:
+            weekdays.add(0)
+        self.weekdays = weekdays
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    def __day_matches(self, when):
+        weekday = (when.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            return when.day in self.days and weekday in self.weekdays
+        return when.day in self.days or weekday in self.weekdays
+
+    def next_after(self, when):
+        """Return the first matching minute strictly after when."""
+        when = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months:
+                year = when.year + when.month // 12
+                when = when.replace(year=year, month=when.month % 12 + 1,
+                                    day=1, hour=0, minute=0)
+            elif not self.__day_matches(when):
+                when = (when + timedelta(days=1)).replace(hour=0, minute=0)
+            elif when.hour not in self.hours:
+                when = (when + timedelta(hours=1)).replace(minute=0)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ScheduleError('Cron expression %s never matches' %
+                            self.expression)
+
+
+@contextmanager
+def job_lock(path):
+    """Hold an exclusive lock on path for the duration of the block, or
+    yield False without waiting if another thread or process holds it."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+    lock_file = open(path, 'a')
+    try:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+
+class Job(object):
+    def __init__(self, name, schedule, func, lock_path):
+        self.name = name
+        self.schedule = CronSchedule(schedule)
+        self.func = func
+        self.lock_path = lock_path
+        self.next_run = None
+
+    def __str__(self):
+        return 'job %s (%s)' % (self.name, self.schedule)
+
+
+def _log(message):
+    print('%s %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message))
+
+
+def _run_job(job):
+    with job_lock(job.lock_path) as locked:
+        if not locked:
+            _log('Skipping %s, previous run still in progress' % job)
+            return
+        _log('Starting %s' % job)
+        started = time.time()
+        try:
+            job.func()
+            _log('Finished %s in %.1fs' % (job, time.time() - started))
+        except Exception as error:
+            _log('Failed %s after %.1fs: %s' % (job, time.time() - started,
+                                                error))
+
+
+class Scheduler(object):
+    """Run jobs on their cron schedules from a pool of worker threads until
+    stopped by SIGTERM or SIGINT. Jobs are skipped rather than queued while
+    a previous run of the same job still holds its lock."""
+
+    def __init__(self, jobs, workers=4):
+        self.jobs = jobs
+        self.workers = workers
+        self.__stopped = threading.Event()
+
+    def stop(self, *args):
+        self.__stopped.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        pool = ThreadPool(self.workers)
+        now = datetime.now()
+        for job in self.jobs:
+            job.next_run = job.schedule.next_after(now)
+            _log('Scheduled %s, next run at %s' % (job, job.next_run))
+        try:
+            while not self.__stopped.is_set():
+                now = datetime.now()
+                for job in self.jobs:
+                    if job.next_run <= now:
+                        pool.apply_async(_run_job, (job,))
+                        job.next_run = job.schedule.next_after(now)
+                wake = min(job.next_run for job in self.jobs)
+                delay = (wake - datetime.now()).total_seconds()
+                self.__stopped.wait(max(0.5, min(delay, 60)))
+        finally:
+            _log('Stopping, waiting for running jobs to finish')
+            pool.close()
+            pool.join()
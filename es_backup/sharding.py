@@ -0,0 +1,109 @@
+import heapq
+import time
+from multiprocessing.pool import ThreadPool
+from es_backup.cache import cache, snapshot_keys
+from es_backup.client import client
+from es_backup.config import config
+from es_backup.progress import wait_for_snapshot
+from es_backup.snapshot import Snapshot
+
+
+def list_indices(pattern='_all'):
+    """Return a dict of index name to store size in bytes for every open
+    index matching the multi-index pattern."""
+    base_url = config.get('default', 'base_url')
+    response = client.get('%s/_cat/indices/%s' % (base_url, pattern),
+                          params={'format': 'json', 'bytes': 'b',
+                                  'h': 'index,store.size',
+                                  'expand_wildcards': 'open'})
+    response.raise_for_status()
+    return dict((row['index'], int(row.get('store.size') or 0))
+                for row in response.json())
+
+
+def pack_indices(sizes, groups):
+    """Distribute indices over at most groups bins of roughly equal store
+    size, largest index first into the currently smallest bin."""
+    bins = [(0, i, []) for i in range(min(groups, len(sizes)))]
+    for index in sorted(sizes, key=lambda name: sizes[name], reverse=True):
+        total, i, members = heapq.heappop(bins)
+        members.append(index)
+        heapq.heappush(bins, (total + sizes[index], i, members))
+    return [members for total, i, members in sorted(bins,
+                                                    key=lambda b: b[1])]
+
+
+def _discard_snapshot(repo, name):
+    response = client.delete('%s/%s' % (repo.url, name), timeout=None)
+    cache.invalidate(*snapshot_keys(repo, name))
+    if response.status_code != 404:
+        response.raise_for_status()
+
+
+def _run_group(job):
+    repo, name, indices, options = job
+    started = time.time()
+    try:
+        snapshot = Snapshot(name, repo, indices=','.join(indices), **options)
+        summary = wait_for_snapshot(snapshot, quiet=True)
+    except Exception as error:
+        summary = {'repository': repo.name, 'snapshot': name,
+                   'state': 'ERROR', 'error': str(error),
+                   'duration': round(time.time() - started, 3), 'bytes': 0,
+                   'files': 0, 'shards_total': 0, 'shards_failed': 0}
+    summary['indices'] = len(indices)
+    return summary
+
+
+def snapshot_groups(repo, name, groups, max_concurrent=1, retries=0,
+                    **options):
+    """Snapshot each group of indices as <name>_<n>, running at most
+    max_concurrent snapshots at a time.
+
+    Groups that do not finish with SUCCESS are deleted and retried up to
+    retries times, unless deleting them fails; the others are left alone. The global state is only
+    included in the first group. Returns the final summary of each group.
+    """
+    jobs = []
+    for i, indices in enumerate(groups):
+        group_options = dict(options)
+        if i > 0:
+            group_options['include_global_state'] = False
+        jobs.append((repo, '%s_%s' % (name, i + 1), indices, group_options))
+
+    names = [job[1] for job in jobs]
+    results = {}
+    pool = ThreadPool(max(1, min(max_concurrent, len(jobs))),
+                      initializer=config.inherit())
+    try:
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                retried = []
+                for job in jobs:
+                    try:
+                        _discard_snapshot(repo, job[1])
+                    except Exception as error:
+                        print('Not retrying snapshot %s, deleting it failed: '
+                              '%s' % (job[1], error))
+                        results[job[1]]['error'] = (
+                            'delete before retry failed: %s' % error)
+                        continue
+                    print('Retrying snapshot %s (attempt %s of %s)' % (
+                          job[1], attempt + 1, retries + 1))
+                    retried.append(job)
+                jobs = retried
+                if not jobs:
+                    break
+            for summary in pool.imap_unordered(_run_group, jobs):
+                results[summary['snapshot']] = summary
+                print('Snapshot %s of %s indices finished %s in %.1fs' % (
+                      summary['snapshot'], summary['indices'],
+                      summary['state'], summary['duration']))
+            jobs = [job for job in jobs
+                    if results[job[1]]['state'] != 'SUCCESS']
+            if not jobs:
+                break
+    finally:
+        pool.close()
+        pool.join()
+    return [results[group] for group in names]
@@ -0,0 +1,139 @@
+import struct
+
+HEADER = b':)\n'
+SHARED_LIMIT = 1024
+
+
+class SmileError(ValueError):
+    pass
+
+
+class _Decoder(object):
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+        if bytes(self.data[:3]) != HEADER:
+            raise SmileError('Missing smile header')
+        flags = self.data[3]
+        self.shared_names = [] if flags & 0x01 else None
+        self.shared_values = [] if flags & 0x02 else None
+        self.pos = 4
+
+    def byte(self):
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def text(self, length):
+        start = self.pos
+        self.pos += length
+        return bytes(self.data[start:self.pos]).decode('utf-8')
+
+    def terminated(self):
+        end = self.data.index(b'\xfc', self.pos)
+        value = bytes(self.data[self.pos:end]).decode('utf-8')
+        self.pos = end + 1
+        return value
+
+    def vint(self):
+        value = 0
+        while True:
+            b = self.byte()
+            if b & 0x80:
+                return (value << 6) | (b & 0x3F)
+            value = (value << 7) | b
+
+    def zigzag(self):
+        n = self.vint()
+        return (n >> 1) ^ -(n & 1)
+
+    def bits(self, count, width):
+        value = 0
+        for _ in range(count):
+            value = (value << 7) | self.byte()
+        return value & ((1 << width) - 1)
+
+    def remember(self, shared, value):
+        if shared is None:
+            return
+        if len(shared) >= SHARED_LIMIT:
+            del shared[:]
+        shared.append(value)
+
+    def key(self, b):
+        if b == 0x20:
+            return ''
+        if 0x30 <= b <= 0x33:
+            return self.shared_names[((b & 0x03) << 8) | self.byte()]
+        if 0x40 <= b <= 0x7F:
+            return self.shared_names[b & 0x3F]
+        if b == 0x34:
+            name = self.terminated()
+        elif 0x80 <= b <= 0xBF:
+            name = self.text((b & 0x3F) + 1)
+        elif 0xC0 <= b <= 0xF7:
+            name = self.text((b & 0x3F) + 2)
+        else:
+            raise SmileError('Unexpected key token 0x%02x at %s' %
+                             (b, self.pos - 1))
+        self.remember(self.shared_names, name)
+        return name
+
+    def value(self):
+        b = self.byte()
+        if 0x01 <= b <= 0x1F:
+            return self.shared_values[b - 1]
+        if b == 0x20:
+            return ''
+        if b == 0x21:
+            return None
+        if b in (0x22, 0x23):
+            return b == 0x23
+        if b in (0x24, 0x25):
+            return self.zigzag()
+        if b == 0x28:
+            return struct.unpack('>f', struct.pack('>I',
+                                                   self.bits(5, 32)))[0]
+        if b == 0x29:
+            return struct.unpack('>d', struct.pack('>Q',
+                                                   self.bits(10, 64)))[0]
+        if 0x40 <= b <= 0xBF:
+            if b < 0x60:
+                value = self.text((b & 0x1F) + 1)
+            elif b < 0x80:
+                value = self.text((b & 0x1F) + 33)
+            elif b < 0xA0:
+                value = self.text((b & 0x1F) + 2)
+            else:
+                value = self.text((b & 0x1F) + 34)
+            self.remember(self.shared_values, value)
+            return value
+        if 0xC0 <= b <= 0xDF:
+            n = b & 0x1F
+            return (n >> 1) ^ -(n & 1)
+        if b in (0xE0, 0xE4):
+            return self.terminated()
+        if 0xEC <= b <= 0xEF:
+            return self.shared_values[((b & 0x03) << 8) | self.byte()]
+        if b == 0xF8:
+            items = []
+            while self.data[self.pos] != 0xF9:
+                items.append(self.value())
+            self.pos += 1
+            return items
+        if b == 0xFA:
+            obj = {}
+            while True:
+                b = self.byte()
+                if b == 0xFB:
+                    return obj
+                key = self.key(b)
+                obj[key] = self.value()
+        raise SmileError('Unsupported value token 0x%02x at %s' %
+                         (b, self.pos - 1))
+
+
+def loads(data):
+    """Decode a smile document holding the structures written by
+    elasticsearch: objects, arrays, strings, numbers, booleans and null."""
+    return _Decoder(data).value()
@@ -1,47 +1,109 @@
 import json
-import requests
-from dateutil.parser import *
+from datetime import datetime
+from es_backup.cache import COMPLETED_STATES, cache, snapshot_keys
+from es_backup.client import client
+from es_backup.metrics import metrics
+
+
+def _time(snapshot, field):
+    millis = snapshot.get('%s_in_millis' % field)
+    if millis is not None:
+        from dateutil.tz import tzutc
+        return datetime.fromtimestamp(millis / 1000.0, tzutc())
+    if snapshot.get(field):
+        from dateutil.parser import parse
+        return parse(snapshot[field])
+    return None
 
 
 class Snapshot(object):
+    """Snapshot of a repository. The metadata returned by elasticsearch is
+    kept as is and only decoded when an attribute is read, so listings of
+    many snapshots stay cheap."""
+
+    __slots__ = ('name', 'repo', 'ignore_unavailable',
+                 'include_global_state', 'partial', 'state', '_indices',
+                 '_data')
+
     def __init__(self, name, repo, indices='_all', ignore_unavailable=False,
-                 include_global_state=True, partial=False):
+                 include_global_state=True, partial=False, data=None):
         self.name = name
         self.repo = repo
-        self.url = '%s/%s' % (repo.url, self.name)
-        self.indices = indices
         self.ignore_unavailable = ignore_unavailable
         self.include_global_state = include_global_state
         self.partial = partial
+        self.state = None
+        self._indices = indices
+        self._data = {}
 
-        if self.__get_snapshot() is False:
+        if data is not None:
+            self.__load_snapshot(data)
+        elif self.__get_snapshot(cached=False) is False:
             self.__create_snapshot()
-            self.__get_snapshot()
+            self.__get_snapshot(cached=False)
 
     def __str__(self):
         return 'Snapshot %s of repo %s' % (self.name, self.repo.name)
 
-    def __get_snapshot(self):
-        response = requests.get(self.url)
+    @property
+    def url(self):
+        return '%s/%s' % (self.repo.url, self.name)
+
+    @property
+    def indices(self):
+        if 'indices' in self._data:
+            return ','.join(self._data['indices']) or '_all'
+        return self._indices
+
+    @property
+    def start_time(self):
+        return _time(self._data, 'start_time')
+
+    @property
+    def end_time(self):
+        return _time(self._data, 'end_time')
+
+    @property
+    def duration(self):
+        if self._data.get('duration_in_millis'):
+            return self._data['duration_in_millis'] / 1000.0
+        return None
+
+    @property
+    def failures(self):
+        return self._data.get('failures')
+
+    @property
+    def shards(self):
+        return self._data.get('shards')
+
+    def __get_snapshot(self, cached=True):
+        if cached:
+            key = self.repo.snapshot_key(self.name)
+            snapshot = cache.get(key) if key else None
+            if snapshot is not None:
+                self.__load_snapshot(snapshot)
+                return True
+        response = client.get(self.url)
         if response.status_code < 300:
             data = response.json()
             snapshot = data['snapshots'][0]
-            indices = ','.join(snapshot.get('indices'))
-            if indices is '':
-                self.indices = '_all'
-            else:
-                self.indices = indices
-            self.state = snapshot.get('state')
-            self.start_time = parse(snapshot.get('start_time'))
-            if snapshot.get('end_time'):
-                self.end_time = parse(snapshot.get('end_time'))
-            if snapshot.get('duration_in_millis'):
-                self.duration = snapshot.get('duration_in_millis') / 1000.0
-            self.failures = snapshot.get('failures')
-            self.shards = snapshot.get('shards')
+            self.__load_snapshot(snapshot)
+            if snapshot.get('state') in COMPLETED_STATES:
+                key = self.repo.snapshot_key(self.name)
+                if key:
+                    cache.set(key, snapshot)
+                metrics.snapshot(self.repo.name, self.name, self.state,
+                                 duration=self.duration,
+                                 failed_shards=(self.shards or {}).get(
+                                     'failed'))
             return True
         return False
 
+    def __load_snapshot(self, snapshot):
+        self._data = snapshot
+        self.state = snapshot.get('state')
+
     def __create_snapshot(self):
         snapshot_data = {
             'indices': self.indices,
@@ -49,15 +111,36 @@ class Snapshot(object):
             'include_global_state': self.include_global_state,
             'partial': self.partial
         }
-        response = requests.put(self.url, data=json.dumps(snapshot_data))
+        response = client.put(self.url, data=json.dumps(snapshot_data))
+        cache.invalidate(*snapshot_keys(self.repo))
+        response.raise_for_status()
 
     def update_status(self):
         self.__get_snapshot()
 
+    def status(self):
+        response = client.get('%s/_status' % self.url)
+        response.raise_for_status()
+        return response.json()['snapshots'][0]
+
     def delete(self):
-        response = requests.delete(self.url)
+        response = client.delete(self.url, timeout=None)
+        cache.invalidate(*snapshot_keys(self.repo, self.name))
         if response.status_code >= 400:
             response.raise_for_status()
 
-    def restore(self):
-        pass
+    def restore(self, indices=None, rename_pattern=None,
+                rename_replacement=None, ignore_unavailable=False,
+                include_global_state=False, partial=False):
+        restore_data = {
+            'indices': indices or self.indices,
+            'ignore_unavailable': ignore_unavailable,
+            'include_global_state': include_global_state,
+            'partial': partial
+        }
+        if rename_pattern is not None:
+            restore_data['rename_pattern'] = rename_pattern
+            restore_data['rename_replacement'] = rename_replacement
+        response = client.post('%s/_restore' % self.url,
+                               data=json.dumps(restore_data))
+        response.raise_for_status()
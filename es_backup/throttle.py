@@ -0,0 +1,201 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from es_backup.client import client
+from es_backup.config import config, option
+
+UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2,
+         'mb': 1024 ** 2, 'g': 1024 ** 3, 'gb': 1024 ** 3}
+
+
+def parse_rate(rate):
+    """Convert an elasticsearch byte size such as 20mb to bytes."""
+    match = re.match(r'^\s*([\d.]+)\s*([kmg]?b?)\s*$', str(rate).lower())
+    if not match:
+        raise ValueError('Invalid rate %s' % rate)
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def format_rate(rate):
+    if rate >= UNITS['gb'] and rate % UNITS['gb'] == 0:
+        return '%dgb' % (rate // UNITS['gb'])
+    if rate >= UNITS['mb'] and rate % UNITS['mb'] == 0:
+        return '%dmb' % (rate // UNITS['mb'])
+    return '%dkb' % max(1, rate // UNITS['kb'])
+
+
+def _cause(error):
+    """Return the reason elasticsearch gave for a failed request, or the
+    error itself."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return str(error)
+    try:
+        return response.json()['error']['reason']
+    except (ValueError, KeyError, TypeError):
+        return response.text or str(error)
+
+
+def sample_nodes():
+    """Return cumulative per-node search, thread pool and IO counters."""
+    base_url = config.get('default', 'base_url')
+    response = client.get('%s/_nodes/stats/indices,thread_pool,fs' %
+                          base_url,
+                          params={'filter_path': 'nodes.*.name,'
+                                  'nodes.*.indices.search,'
+                                  'nodes.*.thread_pool.search.queue,'
+                                  'nodes.*.thread_pool.write.queue,'
+                                  'nodes.*.fs.io_stats.total'})
+    response.raise_for_status()
+    nodes = {}
+    for node_id, node in response.json().get('nodes', {}).items():
+        search = node.get('indices', {}).get('search', {})
+        pools = node.get('thread_pool', {})
+        io = node.get('fs', {}).get('io_stats', {}).get('total', {})
+        nodes[node_id] = {
+            'name': node.get('name', node_id),
+            'query_total': search.get('query_total', 0),
+            'query_time': search.get('query_time_in_millis', 0),
+            'queue': sum(pool.get('queue', 0) for pool in pools.values()),
+            'io_time': io.get('io_time_in_millis')
+        }
+    return nodes
+
+
+def node_load(previous, current, interval):
+    """Return (search latency ms, queued tasks, io utilization) of the
+    busiest node between two samples taken interval seconds apart."""
+    latency, queue, utilization = 0.0, 0, 0.0
+    for node_id, now in current.items():
+        queue = max(queue, now['queue'])
+        before = previous.get(node_id)
+        if before is None:
+            continue
+        queries = now['query_total'] - before['query_total']
+        if queries > 0:
+            latency = max(latency, float(now['query_time'] -
+                                         before['query_time']) / queries)
+        if now['io_time'] is not None and before['io_time'] is not None:
+            utilization = max(utilization, (now['io_time'] -
+                                            before['io_time']) /
+                              (interval * 1000.0))
+    return latency, queue, utilization
+
+
+class RateController(threading.Thread):
+    """Background thread that samples node load every interval seconds and
+    re-PUTs a rate setting of a repository, lowering it by step while the
+    cluster is over any of its load limits and raising it otherwise, within
+    min_rate and max_rate. The original rate is put back on stop.
+
+    Clusters that reject repository changes while a snapshot or restore is
+    running (elasticsearch 7.x) stop the controller at the first rejected
+    change; the rate then stays where it was until stop."""
+
+    def __init__(self, repo, setting, min_rate, max_rate, step=1.5,
+                 interval=30.0, max_latency=50.0, max_queue=10,
+                 max_io=0.8):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.repo = repo
+        self.setting = setting
+        self.min_rate = parse_rate(min_rate)
+        self.max_rate = parse_rate(max_rate)
+        self.step = step
+        self.interval = interval
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.max_io = max_io
+        self.original = None
+        self.rate = None
+        self.__stopped = threading.Event()
+        self.__overrides = config.inherit()
+
+    def __log(self, message):
+        print('%s %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                         message))
+
+    def __set_rate(self, rate, reason):
+        self.repo.update_settings(**{self.setting: format_rate(rate)})
+        self.__log('%s of repository %s changed from %s to %s (%s)' % (
+                   self.setting, self.repo.name, format_rate(self.rate),
+                   format_rate(rate), reason))
+        self.rate = rate
+
+    def adjust(self, latency, queue, utilization):
+        if (latency > self.max_latency or queue > self.max_queue or
+                utilization > self.max_io):
+            rate = max(self.min_rate, int(self.rate / self.step))
+        else:
+            rate = min(self.max_rate, int(self.rate * self.step))
+        if rate != self.rate:
+            self.__set_rate(rate, 'search latency %.1fms, %s queued, io '
+                            '%.0f%%' % (latency, queue, utilization * 100))
+
+    def run(self):
+        self.__overrides()
+        settings = self.repo.get_settings()['settings']
+        self.original = settings.get(self.setting, '20mb')
+        self.rate = parse_rate(self.original)
+        previous, sampled = sample_nodes(), time.time()
+        while not self.__stopped.wait(self.interval):
+            try:
+                current, now = sample_nodes(), time.time()
+            except Exception as error:
+                self.__log('Rate controller of repository %s failed to '
+                           'sample: %s' % (self.repo.name, error))
+                continue
+            load = node_load(previous, current, now - sampled)
+            previous, sampled = current, now
+            try:
+                self.adjust(*load)
+            except Exception as error:
+                self.__log('Rate controller of repository %s stopped, %s '
+                           'was rejected: %s' % (self.repo.name,
+                                                 self.setting,
+                                                 _cause(error)))
+                return
+
+    def stop(self):
+        self.__stopped.set()
+        self.join()
+        if self.original is not None and \
+                self.rate != parse_rate(self.original):
+            try:
+                self.__set_rate(parse_rate(self.original), 'finished')
+            except Exception as error:
+                self.__log('Could not put %s of repository %s back to %s: '
+                           '%s' % (self.setting, self.repo.name,
+                                   self.original, _cause(error)))
+
+
+def start_adaptive_rate(repo, setting):
+    """Start adjusting setting of repo to the cluster load, using the limits
+    of the [throttle] section, and return the controller to stop."""
+    controller = RateController(
+        repo, setting, option('throttle', 'min_rate', '10mb'),
+        option('throttle', 'max_rate', '200mb'),
+        step=option('throttle', 'step', 1.5, 'getfloat'),
+        interval=option('throttle', 'interval', 30.0, 'getfloat'),
+        max_latency=option('throttle', 'max_search_latency', 50.0,
+                           'getfloat'),
+        max_queue=option('throttle', 'max_queue', 10, 'getint'),
+        max_io=option('throttle', 'max_io_utilization', 0.8, 'getfloat'))
+    controller.start()
+    return controller
+
+
+@contextmanager
+def adaptive_rate(repo, setting, enabled=True):
+    """Adjust setting of repo to the cluster load for the duration of the
+    block when enabled."""
+    if not enabled:
+        yield None
+        return
+    controller = start_adaptive_rate(repo, setting)
+    try:
+        yield controller
+    finally:
+        controller.stop()
@@ -0,0 +1,152 @@
+import os
+import re
+from multiprocessing import Pool
+from es_backup.catalog import OfflineRepository, read_blob
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+PART_SUFFIX = re.compile(r'\.part\d+$')
+
+
+def _metadata_files(path):
+    """Yield (uuid, size) of the snapshot level snap-/meta- blobs directly
+    under path, with uuid None for any other file."""
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            continue
+        size = entry.stat(follow_symlinks=False).st_size
+        match = re.match(r'^(?:snap|meta)-(.+)\.dat$', entry.name)
+        yield (match.group(1) if match else None), size
+
+
+def shard_dirs(location):
+    """Yield every indices/<index>/<shard> directory of a repository."""
+    indices = os.path.join(location, 'indices')
+    if not os.path.isdir(indices):
+        return
+    for index in scandir(indices):
+        if not index.is_dir(follow_symlinks=False):
+            continue
+        for shard in scandir(index.path):
+            if shard.is_dir(follow_symlinks=False):
+                yield shard.path
+
+
+def _scan_shard(job):
+    """Size the blobs of one shard directory and attribute them to the
+    snapshots whose shard snapshot file references them.
+
+    Returns a dict with usage mapping snapshot uuid to [unique, shared]
+    bytes, the shared, metadata, unreferenced and reclaimable byte counts
+    of the directory and any error raised reading it.
+    """
+    path, deleted = job
+    blobs = {}
+    snapshots = {}
+    metadata = 0
+    try:
+        for entry in scandir(path):
+            size = entry.stat(follow_symlinks=False).st_size
+            if entry.name.startswith('__'):
+                name = PART_SUFFIX.sub('', entry.name)
+                blobs[name] = blobs.get(name, 0) + size
+            elif (entry.name.startswith('snap-') and
+                    entry.name.endswith('.dat')):
+                snapshots[entry.name[5:-4]] = (entry.path, size)
+            else:
+                metadata += size
+
+        refs = {}
+        usage = {}
+        for uuid, (snap_path, size) in snapshots.items():
+            usage[uuid] = [size, 0]
+            for info in read_blob(snap_path).get('files', []):
+                refs.setdefault(info['name'], []).append(uuid)
+    except Exception as error:
+        return {'path': path, 'error': '%s' % error}
+
+    shared = 0
+    unreferenced = 0
+    reclaimable = sum(size for uuid, (snap_path, size) in snapshots.items()
+                      if uuid in deleted)
+    for name, size in blobs.items():
+        owners = refs.get(name)
+        if not owners:
+            unreferenced += size
+            continue
+        if len(owners) == 1:
+            usage[owners[0]][0] += size
+        else:
+            shared += size
+            for uuid in owners:
+                usage[uuid][1] += size
+        if all(uuid in deleted for uuid in owners):
+            reclaimable += size
+    return {'path': path, 'usage': usage, 'shared': shared,
+            'metadata': metadata, 'unreferenced': unreferenced,
+            'reclaimable': reclaimable, 'error': None}
+
+
+def repo_usage(location, workers=4, delete=None):
+    """Walk an fs repository and report per snapshot unique and shared
+    bytes.
+
+    Shard directories are scanned by a pool of worker processes and only
+    the per-snapshot totals are kept, so memory stays bounded by the
+    largest shard directory. delete names snapshots whose combined
+    reclaimable space is reported.
+    """
+    catalog = OfflineRepository(os.path.basename(location), location)
+    names = {}
+    for snapshot in catalog.list_snapshots():
+        names[snapshot.uuid] = snapshot.name
+    uuids = dict((name, uuid) for uuid, name in names.items())
+    deleted = set(uuids[name] for name in (delete or []) if name in uuids)
+
+    totals = dict((uuid, [0, 0]) for uuid in names)
+    sums = {'shared': 0, 'metadata': 0, 'unreferenced': 0,
+            'reclaimable': 0}
+    for uuid, size in _metadata_files(location):
+        if uuid in totals:
+            totals[uuid][0] += size
+            if uuid in deleted:
+                sums['reclaimable'] += size
+        else:
+            sums['metadata'] += size
+    errors = []
+    pool = Pool(workers)
+    try:
+        jobs = ((path, deleted) for path in shard_dirs(location))
+        for result in pool.imap_unordered(_scan_shard, jobs, chunksize=16):
+            if result['error']:
+                errors.append((result['path'], result['error']))
+                continue
+            for uuid, (unique, shared) in result['usage'].items():
+                total = totals.setdefault(uuid, [0, 0])
+                total[0] += unique
+                total[1] += shared
+            for key in sums:
+                sums[key] += result[key]
+    finally:
+        pool.close()
+        pool.join()
+
+    snapshots = []
+    for uuid, (unique, shared) in totals.items():
+        snapshots.append({'name': names.get(uuid, uuid), 'uuid': uuid,
+                          'unique': unique, 'shared': shared})
+    snapshots.sort(key=lambda snapshot: snapshot['name'])
+    return {
+        'location': location,
+        'snapshots': snapshots,
+        'unique': sum(snapshot['unique'] for snapshot in snapshots),
+        'shared': sums['shared'],
+        'metadata': sums['metadata'],
+        'unreferenced': sums['unreferenced'],
+        'delete': sorted(name for name in delete or [] if name in uuids),
+        'reclaimable': sums['reclaimable'],
+        'errors': errors
+    }
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zlib
+from multiprocessing import Pool
+from es_backup.catalog import OfflineRepository, map_file, read_blob
+from es_backup.usage import shard_dirs
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    _window = buffer
+except NameError:
+    def _window(data, offset, size):
+        return memoryview(data)[offset:offset + size]
+
+FOOTER_MAGIC = 0xC02893E8
+FOOTER_LENGTH = 16
+WINDOW_SIZE = 64 * 1024 * 1024
+VIRTUAL_PREFIX = 'v__'
+
+
+def blob_parts(name, length, part_size=None):
+    """Return the (file name, size) of each part a blob of length bytes is
+    stored as, following the .partN naming of elasticsearch."""
+    if not part_size or length <= part_size:
+        return [(name, length)]
+    count = (length + part_size - 1) // part_size
+    return [('%s.part%s' % (name, i),
+             min(part_size, length - i * part_size)) for i in range(count)]
+
+
+def _read_shard(path):
+    """Read the shard snapshot files of a shard directory and return the
+    blobs they reference with the snapshots referencing each, along with
+    the shard snapshot files that could not be read."""
+    blobs = {}
+    broken = []
+    try:
+        entries = [entry for entry in scandir(path)
+                   if entry.name.startswith('snap-') and
+                   entry.name.endswith('.dat')]
+    except OSError as error:
+        entries = []
+        broken.append(('', None, 'unreadable: %s' % error))
+    for entry in entries:
+        uuid = entry.name[5:-4]
+        try:
+            files = read_blob(entry.path).get('files', [])
+        except Exception as error:
+            broken.append((entry.name, uuid, 'unreadable: %s' % error))
+            continue
+        for info in files:
+            if info['name'].startswith(VIRTUAL_PREFIX):
+                continue
+            blob = blobs.setdefault(info['name'], {
+                'length': info.get('length', 0),
+                'checksum': info.get('checksum'),
+                'part_size': info.get('part_size'), 'snapshots': []})
+            blob['snapshots'].append(uuid)
+    return {'path': path, 'blobs': blobs, 'broken': broken}
+
+
+def _checksum(paths, length):
+    """Return the CRC32 lucene stores in the footer of a file split over
+    paths, and the CRC32 of everything before it, reading through memory
+    maps."""
+    crc = 0
+    offset = 0
+    footer = b''
+    for path in paths:
+        data = map_file(path)
+        try:
+            size = len(data)
+            end = min(size, max(0, length - 8 - offset))
+            for start in range(0, end, WINDOW_SIZE):
+                crc = zlib.crc32(_window(data, start,
+                                         min(WINDOW_SIZE, end - start)), crc)
+            tail = max(0, length - FOOTER_LENGTH - offset)
+            if tail < size:
+                footer += data[tail:size]
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+        offset += size
+    if len(footer) != FOOTER_LENGTH or \
+            struct.unpack('>I', footer[:4])[0] != FOOTER_MAGIC:
+        return None, None
+    return struct.unpack('>q', footer[8:])[0], crc & 0xffffffff
+
+
+def _verify_blob(job):
+    """Check the parts of a blob exist with the expected sizes and that its
+    content matches the checksum recorded at snapshot time. A blob without
+    a lucene footer is only accepted when the snapshot recorded no checksum
+    for it. known is the stamp of an earlier successful check; the content
+    is not read again while the stamp is unchanged. Returns (key, error,
+    stamp)."""
+    shard_path, name, length, checksum, part_size, known = job
+    key = os.path.join(shard_path, name)
+    stamp = []
+    paths = []
+    for part, size in blob_parts(name, length, part_size):
+        path = os.path.join(shard_path, part)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return key, 'missing %s' % part, None
+        if stat.st_size != size:
+            return key, '%s is %s bytes, expected %s' % (
+                part, stat.st_size, size), None
+        stamp.append([stat.st_size, int(stat.st_mtime)])
+        paths.append(path)
+    if known == stamp:
+        return key, None, stamp
+    try:
+        footer, crc = _checksum(paths, length)
+    except (IOError, OSError) as error:
+        return key, 'unreadable: %s' % error, None
+    if footer is None:
+        if checksum:
+            return key, 'missing or corrupt footer', None
+        return key, None, stamp
+    if footer != crc:
+        return key, 'checksum mismatch', None
+    if checksum:
+        try:
+            if int(checksum, 36) != crc:
+                return key, 'checksum differs from snapshot metadata', None
+        except ValueError:
+            pass
+    return key, None, stamp
+
+
+def state_path(cache_path, location):
+    digest = hashlib.sha1(location.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser(cache_path), 'verify',
+                        '%s.json' % digest)
+
+
+def _load_state(path):
+    try:
+        with open(path) as state:
+            return json.load(state)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_state(path, verified):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.verify-')
+    with os.fdopen(fd, 'w') as state:
+        json.dump(verified, state)
+    os.rename(temp, path)
+
+
+def verify_repo(location, workers=4, state_file=None):
+    """Check every blob referenced by the shard snapshots of the fs
+    repository at location for existence, size and checksum.
+
+    Shard snapshot files are read and blobs hashed by a pool of worker
+    processes, each blob once however many snapshots share it. With a
+    state_file, blobs whose parts have the size and mtime they had when
+    last verified are only checked for existence and size. Returns a report
+    of the blobs checked and hashed, and of each broken blob or metadata
+    file with the snapshots and indices it affects.
+    """
+    catalog = OfflineRepository(os.path.basename(location), location)
+    names = {}
+    for entry in catalog.data.get('snapshots', []):
+        if isinstance(entry, dict):
+            names[entry.get('uuid', entry['name'])] = entry['name']
+    index_names = dict((entry['id'], name) for name, entry in
+                       catalog.data.get('indices', {}).items())
+    known = _load_state(state_file) if state_file else {}
+
+    broken = []
+
+    def add_broken(path, reason, uuids, index=None, shard=None):
+        broken.append({'path': os.path.relpath(path, location),
+                       'reason': reason, 'index': index, 'shard': shard,
+                       'snapshots': sorted(names.get(uuid, uuid)
+                                           for uuid in set(uuids))})
+
+    for uuid, name in sorted(names.items()):
+        path = os.path.join(location, 'snap-%s.dat' % uuid)
+        if not os.path.exists(path):
+            add_broken(path, 'missing snapshot metadata', [uuid])
+
+    jobs = []
+    owners = {}
+    verified = {}
+    pool = Pool(workers)
+    try:
+        for shard in pool.imap_unordered(_read_shard, shard_dirs(location),
+                                         chunksize=8):
+            index_id, shard_id = shard['path'].split(os.sep)[-2:]
+            index = index_names.get(index_id, index_id)
+            for file_name, uuid, reason in shard['broken']:
+                add_broken(os.path.join(shard['path'], file_name), reason,
+                           [uuid] if uuid else [], index, shard_id)
+            for name, blob in shard['blobs'].items():
+                key = os.path.join(shard['path'], name)
+                owners[key] = (blob['snapshots'], index, shard_id)
+                jobs.append((shard['path'], name, blob['length'],
+                             blob['checksum'], blob['part_size'],
+                             known.get(key)))
+        hashed = 0
+        for key, error, stamp in pool.imap_unordered(_verify_blob, jobs,
+                                                     chunksize=4):
+            if error is None:
+                if known.get(key) != stamp:
+                    hashed += 1
+                verified[key] = stamp
+                continue
+            uuids, index, shard_id = owners[key]
+            add_broken(key, error, uuids, index, shard_id)
+    finally:
+        pool.close()
+        pool.join()
+    if state_file:
+        _save_state(state_file, verified)
+
+    affected = {}
+    for blob in broken:
+        for snapshot in blob['snapshots']:
+            indices = affected.setdefault(snapshot, set())
+            if blob['index']:
+                indices.add(blob['index'])
+    broken.sort(key=lambda blob: blob['path'])
+    return {
+        'location': location,
+        'snapshots': len(names),
+        'blobs': len(jobs),
+        'hashed': hashed,
+        'bytes': sum(job[2] for job in jobs),
+        'broken': broken,
+        'affected': sorted((snapshot, sorted(indices))
+                           for snapshot, indices in affected.items())
+    }